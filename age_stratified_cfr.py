@@ -2,18 +2,19 @@
 #
 # Calculates age-stratified Case Fatality Ratios based on the Florida COVID-19 line list data.
 
-import sys, os, math, datetime
-import pandas as pd
+import sys, math, datetime
 import numpy as np
 import scipy.stats as stats
 import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
 import matplotlib.ticker as ticker
-from matplotlib import rcParams
+import matplotlib.colors as colors
+import scipy.signal as signal
+import linelist
+import snapshot_archive
+import case_backfill
+import render
 
-# Florida COVID-19 line list data. CSV found at:
-# https://www.arcgis.com/home/item.html?id=4cc62b3a510949c7a8167f6baa3e069d
-csv_url = 'https://www.arcgis.com/sharing/rest/content/items/4cc62b3a510949c7a8167f6baa3e069d/data'
 # Calculate the CFR on these age brackets
 age_brackets = ((0, 29), (30, 39), (40, 49), (50, 59), (60, 69), (70, 79), (80, 89), (90, math.inf))
 # Averaging period to calculate the raw and short-term adjusted CFR
@@ -29,46 +30,69 @@ t20 = [(x[0] / 255., x[1] / 255., x[2] / 255.) for x in
               (188, 189, 34), (23, 190, 207), (174, 199, 232), (255, 187, 120),
                (152, 223, 138), (255, 152, 150), (197, 176, 213), (196, 156, 148),
                (247, 182, 210), (199, 199, 199), (219, 219, 141), (158, 218, 229)]]
-datadir = 'data_fdoh'
-censoring_rv = None
+# Parameters of the Gamma distribution of onset-to-death, calculated by gamma.py
+o2d_mean, o2d_shape = 25.1, 1.97
 OVERALL = '_overall_'
+# The CFR surface (-surface) is calculated by single year of age up to this age
+# (older cases are counted as this age) and by day of onset, then smoothed by a
+# Gaussian kernel with these standard deviations in years of age and days
+surface_max_age = 100
+surface_sigma = (2.0, 7.0)
+# Cells with fewer cases than this nearby (weighted by the kernel) have no CFR
+surface_min_cases = 20
 
 class Counters():
     deaths = 0
     deaths_adjusted = 0
     cases = 0
+    cases_adjusted = 0
     cfr_raw = None
     cfr_adjusted_short = None
     cfr_adjusted_long = None
 
+# What analyze() returns: the Counters by date of onset and age bracket, along
+# with the onset-to-death parameters used to adjust them for censoring
+class Analysis(dict):
+    def __init__(self, data, mean, shape):
+        super().__init__(data)
+        self.mean = mean
+        self.shape = shape
+
 def age_to_bracket(age):
     for (low, high) in age_brackets:
         if age >= low and age <= high:
             return (low, high)
     raise Exception(f'Could not find bracket for age {age}')
 
-def censoring_factor(mean, shape, days_since_onset):
-    global censoring_rv
-    if censoring_rv is None:
-        censoring_rv = stats.gamma(shape, scale=mean / shape)
-    # To adjust for censoring, deaths will be multiplied by the inverse of
-    # the CDF of the Gamma distribution of onset-to-death. For example if
+def censoring_factor(rv, days_since_onset):
+    # rv is the Gamma distribution of onset-to-death. To adjust for censoring,
+    # deaths will be multiplied by the inverse of the CDF of rv. For example if
     # the CDF tells us only 0.25 (25%) of deaths are expected to have occured
     # on or before a given day, we will multiply deaths by 4. Exception: on
     # day 0 we can't multiply (inverse of CDF is Infinity), so we adjust day 0
     # as if it was day 1.
     if days_since_onset == 0:
         days_since_onset = 1
-    return 1 / censoring_rv.cdf(days_since_onset)
+    return 1 / rv.cdf(days_since_onset)
 
-def calc_cfr(data, mean, shape):
+def calc_cfr(data, mean, shape, backfill=None, date_of_data=None):
+    # backfill is the completeness of cases by lag estimated by case_backfill.py:
+    # if given, the adjusted CFRs also account for the cases of the last days of
+    # onset still to be reported. Their lag is counted from the day of data of
+    # the snapshot, the day prior to date_of_data (from the last date of onset
+    # if date_of_data is not given).
     all_dates = sorted(data.keys())
     last_date = all_dates[-1]
+    data_day = last_date if date_of_data is None else date_of_data - datetime.timedelta(days=1)
+    rv = stats.gamma(shape, scale=mean / shape)
     for date in all_dates:
         for bracket in age_brackets:
             days_since_onset = (last_date - date).days
             data[date][bracket].deaths_adjusted = \
-                    data[date][bracket].deaths * censoring_factor(mean, shape, days_since_onset)
+                    data[date][bracket].deaths * censoring_factor(rv, days_since_onset)
+            data[date][bracket].cases_adjusted = data[date][bracket].cases
+            if backfill is not None:
+                data[date][bracket].cases_adjusted *= case_backfill.adjustment(backfill, (data_day - date).days)
             list_cfr_raw = []
             list_cfr_adj_short = []
             list_cfr_adj_long = []
@@ -80,11 +104,11 @@ def calc_cfr(data, mean, shape):
                         if delta < avg_days:
                             # Accumulate CFR data over the last avg_days days
                             list_cfr_raw.append(p.deaths / p.cases)
-                            list_cfr_adj_short.append(p.deaths_adjusted / p.cases)
+                            list_cfr_adj_short.append(p.deaths_adjusted / p.cases_adjusted)
                         else:
                             # Accumulate CFR data over the avg_days_long days that
                             # are immediately trailing the last avg_days days
-                            list_cfr_adj_long.append(p.deaths_adjusted / p.cases)
+                            list_cfr_adj_long.append(p.deaths_adjusted / p.cases_adjusted)
             # The average CFR is calculated by assigning equal *weight* to each day's CFR value
             if list_cfr_raw:
                 data[date][bracket].cfr_raw = 100 * np.mean(list_cfr_raw)
@@ -97,13 +121,14 @@ def calc_cfr(data, mean, shape):
         for bracket in age_brackets:
             data[date][OVERALL].deaths_adjusted += data[date][bracket].deaths_adjusted
             data[date][OVERALL].cases += data[date][bracket].cases
+            data[date][OVERALL].cases_adjusted += data[date][bracket].cases_adjusted
         list_cfr = []
         for delta in range(avg_days_long):
             date2 = date - datetime.timedelta(days=delta + avg_days)
             if date2 in data:
                 p = data[date2][OVERALL]
                 if p.cases:
-                    list_cfr.append(p.deaths_adjusted / p.cases)
+                    list_cfr.append(p.deaths_adjusted / p.cases_adjusted)
         if list_cfr:
             data[date][OVERALL].cfr_adjusted_long = 100 * np.mean(list_cfr)
 
@@ -129,8 +154,7 @@ def bracket2str(bracket):
         return f'Age {bracket[0]}+'
     return f'Age {bracket[0]}-{bracket[1]}'
 
-def gen_chart(data, mean, shape):
-    rcParams["figure.titlesize"] = "x-large"
+def gen_chart(data, mean, shape, filename, region='Florida'):
     (fig, ax) = plt.subplots(dpi=300, figsize=(6.0, 6.0)) # default is 6.4 × 4.8
     col_i = 0
     for bracket in list(reversed(age_brackets)) + [OVERALL]:
@@ -150,6 +174,10 @@ def gen_chart(data, mean, shape):
             ax.plot(dates, cfrs, linewidth=1.0, color=t20[col_i], linestyle=':')
             ax.plot(dates2, cfrs2, linewidth=1.0, color=t20[col_i], linestyle='--')
         ax.plot(dates3, cfrs3, linewidth=1.0, color=t20[col_i], linestyle='-')
+        if not dates3:
+            # no cases in this bracket (possible for a single county)
+            col_i += 1
+            continue
         last_day, last_cfr = dates3[-1], cfrs3[-1]
         # label the last long-term adjusted CFR
         yo = -5 if bracket == OVERALL else 0
@@ -171,7 +199,7 @@ def gen_chart(data, mean, shape):
     ax.spines['right'].set_visible(False)
     fig.autofmt_xdate()
     ax.tick_params(axis='x', labelsize='x-small')
-    fig.suptitle('CFR of Florida COVID-19 cases\nby age bracket')
+    fig.suptitle(f'CFR of {region} COVID-19 cases\nby age bracket', fontsize='x-large')
     ax.text(
         -0.1,
         -0.14,
@@ -182,47 +210,145 @@ f'a shape parameter of {shape}. Dotted lines: {avg_days}-day moving average of t
 'Created by: Marc Bevand — @zorinaq',
         transform=ax.transAxes, verticalalignment='top', fontsize='small',
     )
-    fig.savefig('age_stratified_cfr.png', bbox_inches='tight')
+    fig.savefig(filename, bbox_inches='tight')
     plt.close()
 
-def main():
-    if len(sys.argv) > 1:
-        fname = sys.argv[1]
-    else:
-        try:
-            files = list(filter(lambda x: x.endswith('.csv') or x.endswith('.csv.gz'), sorted(os.listdir(datadir))))
-        except FileNotFoundError:
-            files = []
-        if files:
-            fname = datadir + os.sep + files[-1]
-        else:
-            fname = csv_url
-    print(f'Opening {fname}')
-    df = pd.read_csv(fname)
-    # Date of onset is EventDate
-    df['date_parsed'] = pd.to_datetime(
-            # Timestamps are formatted as "2020/06/28 05:00:00+00". We truncate
-            # after the whitespace to ignore the time.
-            df['EventDate'].apply(lambda x: x.split(' ')[0]), format='%Y/%m/%d'
-    )
+def bucketize(df):
     data = {}
+    # Date of onset is EventDate
+    df = df[(df['Age'] != linelist.unknown_age) & (df['EventDate'] != linelist.unknown_date)]
     for _, row in df.iterrows():
         age = row['Age']
-        # on 2020-08-07 a case was added with Age=-1.0
-        if math.isnan(age) or age < 0:
-            continue
-        date = row['date_parsed'].date()
-        died = row['Died'] == 'Yes'
+        date = linelist.to_date(row['EventDate'])
+        died = row['Died']
         if date not in data:
             data[date] = {bracket: Counters() for bracket in age_brackets}
         b = age_to_bracket(age)
         data[date][b].deaths += 1 if died else 0
         data[date][b].cases += 1
-    # Parameters of the Gamma distribution of onset-to-death, calculated by gamma.py
-    mean, shape = 25.1, 1.97
-    calc_cfr(data, mean, shape)
+    return data
+
+def analyze(df, mean=o2d_mean, shape=o2d_shape, backfill=None, date_of_data=None):
+    # Return the cases, deaths and CFRs by date of onset and age bracket
+    data = bucketize(df)
+    calc_cfr(data, mean, shape, backfill, date_of_data)
+    return Analysis(data, mean, shape)
+
+def kernel(sigma):
+    # Return a 2D Gaussian kernel truncated at 3 standard deviations, whose
+    # center is 1
+    axes = [np.arange(-math.ceil(3 * s), math.ceil(3 * s) + 1) for s in sigma]
+    return np.outer(*[np.exp(-.5 * (x / s)**2) for (x, s) in zip(axes, sigma)])
+
+def surface(df, mean=o2d_mean, shape=o2d_shape, sigma=surface_sigma):
+    # Return the CFR adjusted for censoring by single year of age and day of onset:
+    # 'cases' and 'deaths_adjusted' are arrays indexed by [age][day - first_day],
+    # and 'cfr' (in percent) is the ratio of both smoothed by the same kernel,
+    # which weighs each case equally like a moving average over ages and days.
+    # 'mean' and 'shape' are the onset-to-death parameters used for the adjustment.
+    df = df[(df['Age'] != linelist.unknown_age) & (df['EventDate'] != linelist.unknown_date)]
+    age = np.minimum(df['Age'].to_numpy(), surface_max_age).astype(np.int64)
+    day = df['EventDate'].to_numpy().astype(np.int64)
+    first_day, last_day = day.min(), day.max()
+    day -= first_day
+    shape2d = (surface_max_age + 1, last_day - first_day + 1)
+    cell = age * shape2d[1] + day
+    size = shape2d[0] * shape2d[1]
+    cases = np.bincount(cell, minlength=size).reshape(shape2d)
+    deaths = np.bincount(cell, weights=df['Died'].to_numpy(), minlength=size).reshape(shape2d)
+    # same adjustment as censoring_factor(), for all days at once
+    rv = stats.gamma(shape, scale=mean / shape)
+    days_since_onset = np.maximum(np.arange(shape2d[1])[::-1], 1)
+    deaths_adjusted = deaths / rv.cdf(days_since_onset)
+    k = kernel(sigma)
+    smooth_cases = signal.fftconvolve(cases, k, mode='same')
+    smooth_deaths = signal.fftconvolve(deaths_adjusted, k, mode='same')
+    cfr = np.full(shape2d, np.nan)
+    ok = smooth_cases >= surface_min_cases
+    # FFT rounding errors may make a smoothed count of zero slightly negative
+    cfr[ok] = 100 * np.maximum(smooth_deaths[ok], 0) / smooth_cases[ok]
+    return {'first_day': int(first_day), 'cases': cases, 'deaths_adjusted': deaths_adjusted, 'cfr': cfr,
+            'mean': mean, 'shape': shape}
+
+def save_surface(surf, filename):
+    np.savez_compressed(filename, ages=np.arange(surface_max_age + 1), **surf)
+
+def gen_surface(surf, mean, shape, filename, region='Florida'):
+    cfr = surf['cfr']
+    first = max(linelist.to_days(first_date) - surf['first_day'], 0)
+    (fig, ax) = plt.subplots(dpi=300)
+    x0 = mdates.date2num(linelist.to_date(surf['first_day'] + first))
+    positive = cfr[cfr > 0]
+    img = ax.imshow(cfr[:, first:], cmap='inferno', origin='lower', interpolation='nearest', aspect='auto',
+            extent=(x0 - .5, x0 + cfr.shape[1] - first - .5, -.5, surface_max_age + .5),
+            norm=colors.LogNorm(vmin=max(positive.min(), .001), vmax=100) if len(positive) else None)
+    ax.xaxis.set_major_locator(mdates.MonthLocator())
+    ax.xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m-%d'))
+    ax.yaxis.set_major_locator(ticker.MultipleLocator(10))
+    ax.spines['top'].set_visible(False)
+    ax.spines['right'].set_visible(False)
+    fig.autofmt_xdate()
+    ax.set_ylabel('Age')
+    ax.set_xlabel('Date of onset of symptoms')
+    cbar = fig.colorbar(img)
+    cbar.ax.yaxis.set_major_formatter(ticker.FormatStrFormatter('%g%%'))
+    cbar.set_label('Case Fatality Ratio')
+    fig.suptitle(f'CFR of {region} COVID-19 cases\nby age and date of onset', fontsize='x-large')
+    ax.text(
+        -0.1,
+        -0.25,
+f'CFR adjusted for right censoring assuming onset-to-death is Gamma distributed with a mean of {mean} days\n'
+f'and a shape parameter of {shape}, smoothed by a Gaussian kernel (σ = {surface_sigma[0]:g} years, {surface_sigma[1]:g} days).\n'
+f'Black: fewer than {surface_min_cases} cases nearby. Ages above {surface_max_age} are counted as {surface_max_age}.\n'
+'Source: https://github.com/mbevand/florida-covid19-line-list-data          '
+'Created by: Marc Bevand — @zorinaq',
+        transform=ax.transAxes, verticalalignment='top', fontsize='small',
+    )
+    ax.set_facecolor('black')
+    fig.savefig(filename, bbox_inches='tight')
+    plt.close()
+
+def charts(data, prefix='', region='Florida'):
+    filename = f'{prefix}age_stratified_cfr.png'
+    return [render.Chart(filename, gen_chart, data, data.mean, data.shape, filename, region=region)]
+
+def recent(fname, days, mean=o2d_mean, shape=o2d_shape, backfill=None):
+    # Return the CFRs of the last days dates of onset only. The CFR of a date
+    # depends on the avg_days + avg_days_long days up to it, so only these days
+    # are read from the snapshot archive.
+    last = snapshot_archive.last_onset(fname)
+    first = last - datetime.timedelta(days=days + avg_days + avg_days_long - 2)
+    data = analyze(snapshot_archive.load(fname, first=first, last=last), mean, shape, backfill,
+            linelist.snapshot_date(fname))
+    return Analysis({date: counters for (date, counters) in data.items() if (last - date).days < days},
+            data.mean, data.shape)
+
+def main():
+    do_surface = len(sys.argv) > 1 and sys.argv[1] == '-surface'
+    if do_surface:
+        sys.argv.pop(1)
+    days = None
+    if len(sys.argv) > 2 and sys.argv[1] == '-days':
+        days = int(sys.argv[2])
+        del sys.argv[1:3]
+    fname = sys.argv[1] if len(sys.argv) > 1 else linelist.latest()
+    print(f'Opening {fname}')
+    # correct the last days of onset for backfill, if enough snapshots were
+    # processed by case_backfill.py
+    backfill = case_backfill.completeness()
+    if days:
+        print_stats(recent(fname, days, backfill=backfill))
+        return
+    df = linelist.load(fname)
+    if do_surface:
+        surf = surface(df)
+        save_surface(surf, 'age_stratified_cfr_surface.npz')
+        filename = 'age_stratified_cfr_surface.png'
+        render.render([render.Chart(filename, gen_surface, surf, surf['mean'], surf['shape'], filename)])
+        return
+    data = analyze(df, backfill=backfill, date_of_data=linelist.snapshot_date(fname))
     #print_stats(data)
-    gen_chart(data, mean, shape)
+    render.render(charts(data))
 
 if __name__ == '__main__':
     main()
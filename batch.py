@@ -0,0 +1,69 @@
+#!/usr/bin/python3
+#
+# Runs the CFR, forecast and heatmap analyses separately for every county (or
+# for every value of another column) of a line list snapshot. The snapshot is
+# parsed only once, and the partitions are analyzed in parallel processes.
+#
+#   $ ./batch.py [-by Jurisdiction] [snapshot]
+#
+# The charts of each partition are written to batch/<column>/<value>/.
+
+import sys, os, re
+import concurrent.futures
+import linelist
+import case_backfill
+import render
+import age_stratified_cfr, forecast_deaths, heatmap
+
+outdir = 'batch'
+# Partition by this column by default
+by = 'County'
+
+def slug(value):
+    # Return a directory name for a partition, eg. "St_Johns" for "St. Johns"
+    return re.sub(r'[^A-Za-z0-9-]+', '_', str(value)).strip('_')
+
+def partition_charts(date_of_data, region, df, prefix, backfill):
+    # Return the charts of one partition. Observed deaths and the population
+    # pyramid are statewide, so they are not charted. The completeness of cases
+    # (backfill) is statewide too, but applies to every partition. Its lags are
+    # counted from the day of data of the snapshot, not from the last day of
+    # onset of the partition.
+    data = age_stratified_cfr.analyze(df, backfill=backfill, date_of_data=date_of_data)
+    charts = age_stratified_cfr.charts(data, prefix=prefix, region=region)
+    cases_per_bracket, _, share_positive, _ = heatmap.analyze(df)
+    charts += heatmap.charts(cases_per_bracket, share_positive, None, prefix=prefix, region=region)
+    deaths = forecast_deaths.forecast(df, backfill=backfill, date_of_data=date_of_data)
+    charts += forecast_deaths.charts(date_of_data, deaths, prefix=prefix, region=region, observed=False)
+    return charts
+
+def main():
+    column = by
+    if len(sys.argv) > 2 and sys.argv[1] == '-by':
+        column = sys.argv[2]
+        del sys.argv[1:3]
+    fname = sys.argv[1] if len(sys.argv) > 1 else linelist.latest()
+    print(f'Opening {fname}')
+    df = linelist.load(fname)
+    date_of_data = linelist.snapshot_date(fname)
+    # correct the last days of onset for backfill, if enough snapshots were
+    # processed by case_backfill.py
+    backfill = case_backfill.completeness()
+    charts = []
+    with concurrent.futures.ProcessPoolExecutor() as executor:
+        futures = {}
+        for (value, part) in df.groupby(column, observed=True):
+            region = f'{value} County' if column == 'County' else str(value)
+            prefix = os.path.join(outdir, column, slug(value), '')
+            os.makedirs(prefix, exist_ok=True)
+            futures[value] = executor.submit(partition_charts, date_of_data, region, part, prefix, backfill)
+        for (value, future) in futures.items():
+            # a partition with too few cases must not prevent charting the others
+            try:
+                charts += future.result()
+            except Exception as e:
+                print(f'Could not analyze {column} {value}: {e!r}')
+    render.render(charts)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/python3
+#
+# Incrementally estimates how the number of cases by date of onset grows as
+# later line list snapshots backfill it, to correct the counts of the last days
+# of onset, which are incomplete.
+#
+#   $ ./case_backfill.py [data_fdoh/2020-09-01-08-00-00.csv.gz ...]
+#   $ ./case_backfill.py -rebuild
+#
+# Updates the estimate with the given snapshots (by default those of data_fdoh
+# downloaded after the last one processed), or with -rebuild refits it from
+# scratch over all the snapshots.
+
+import sys
+import numpy as np
+import linelist
+import snapshot_archive
+import chain_ladder
+
+# State of the incremental estimator
+state_file = 'data_fdoh/case_backfill.npz'
+# Cases are assumed to be fully reported this many days after their onset
+max_lag = 60
+# The estimated growth of a lag is only trusted once this many pairs of
+# consecutive snapshots, with at least this many cases at that lag in total,
+# were compared, and there is no estimate until every lag is trusted.
+min_pairs = 7
+min_cases = 50
+
+def cases_by_onset(df):
+    # Return an array of the number of cases indexed by EventDate
+    days = df['EventDate'].to_numpy()
+    days = days[(days != linelist.unknown_date) & (days >= 0)]
+    return np.bincount(days.astype(np.int64)).astype(np.int32)
+
+def new_state():
+    return chain_ladder.new_state(max_lag)
+
+def load_state():
+    return chain_ladder.load_state(state_file, max_lag)
+
+def save_state(state):
+    chain_ladder.save_state(state, state_file)
+
+def update(state, date, arr):
+    # Update the estimator with the cases by onset arr of the snapshot downloaded
+    # on date. A snapshot contains data for the day prior to its download, whose
+    # cases have lag 0.
+    chain_ladder.update(state, date, arr, linelist.to_days(date) - 1)
+
+def completeness(state=None):
+    # Return an array whose element x is the fraction of the cases of an onset
+    # day reported x days after it, x = 0 .. max_lag, or None if there are not
+    # enough snapshots to estimate it
+    if state is None:
+        state = load_state()
+    return chain_ladder.completeness(state, None, min_pairs, min_cases)
+
+def adjustment(frac, lag):
+    # Return the factors by which to multiply the cases of onset days reported
+    # lag days ago (an array) to correct them for backfill. Days after the day
+    # of data (negative lags) are taken as complete as those of lag 0.
+    return 1 / frac[np.clip(lag, 0, max_lag)]
+
+def print_stats(frac):
+    if frac is None:
+        print('Not enough consecutive snapshots to estimate backfill')
+        return
+    for x in (0, 1, 2, 3, 5, 7, 10, 14, 21, 28):
+        print(f'{100 * frac[x]:5.1f}% of cases reported {x} days after their onset day')
+
+def process(state, fnames):
+    index = snapshot_archive.load_index()
+    for fname in fnames:
+        date = linelist.snapshot_date(fname)
+        if state['last_date'] is not None and date <= state['last_date']:
+            continue
+        print(f'Processing {fname}')
+        # a corrupt snapshot must not prevent processing the others
+        try:
+            arr = cases_by_onset(snapshot_archive.load(fname, index))
+        except Exception as e:
+            print(f'Could not process {fname}: {e!r}')
+            continue
+        update(state, date, arr)
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == '-rebuild':
+        state = new_state()
+        fnames = linelist.snapshots()
+    else:
+        state = load_state()
+        fnames = sys.argv[1:] if len(sys.argv) > 1 else linelist.snapshots()
+    process(state, fnames)
+    save_state(state)
+    print_stats(completeness(state))
+
+if __name__ == '__main__':
+    main()
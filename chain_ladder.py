@@ -0,0 +1,87 @@
+# Incremental chain-ladder estimator of how counts by day (deaths by date of
+# death, cases by date of onset) grow as later snapshots backfill them. Used by
+# reporting_delay.py and case_backfill.py.
+#
+# Comparing each snapshot with the one fetched the day prior gives, for every
+# lag L, the factor num[L] / den[L] by which the count of a day grows from lag L
+# to lag L + 1. Only the previous snapshot is kept in the state, so processing a
+# new snapshot never reads the older ones.
+
+import os, datetime
+import numpy as np
+
+def parse_date(s):
+    return datetime.datetime.strptime(s, '%Y-%m-%d').date()
+
+def new_state(max_lag):
+    # Counts are assumed to be complete max_lag days after their day
+    return {
+            # num[L] / den[L] is the factor by which counts grow from lag L to lag L + 1
+            'num': np.zeros(max_lag),
+            'den': np.zeros(max_lag),
+            # number of pairs of consecutive snapshots that contributed to num[L] and den[L]
+            'pairs': np.zeros(max_lag),
+            # most recent snapshot, the only one needed to process the next one
+            'last': np.zeros(0, dtype=np.int32),
+            'last_date': None,
+            }
+
+def load_state(fname, max_lag):
+    if not os.path.exists(fname):
+        return new_state(max_lag)
+    npz = np.load(fname)
+    state = {k: npz[k] for k in ('num', 'den', 'last')}
+    # state saved before pairs were counted: trust nothing until it is rebuilt
+    state['pairs'] = npz['pairs'] if 'pairs' in npz else np.zeros(max_lag)
+    state['last_date'] = parse_date(str(npz['last_date'])) if npz['last_date'] else None
+    return state
+
+def save_state(state, fname):
+    tmp = fname + '.tmp.npz'
+    np.savez(tmp, num=state['num'], den=state['den'], pairs=state['pairs'], last=state['last'],
+            last_date=str(state['last_date'] or ''))
+    os.replace(tmp, fname)
+
+def update(state, date, arr, lag0):
+    # Update the estimator with the snapshot arr (counts indexed by day) fetched
+    # on date, in which the day of index lag0 has lag 0
+    if state['last_date'] is not None and date <= state['last_date']:
+        print(f'Snapshot of {date} already processed, ignoring')
+        return
+    # Pairs of snapshots more than 1 day apart can not be attributed to a
+    # single lag, so they only serve as the baseline for the next snapshot
+    if state['last_date'] is not None and (date - state['last_date']).days == 1:
+        # days up to lag 0 in prev, a day past the end of an array has a count of 0
+        n = lag0
+        prev, cur = [np.pad(a[:n], (0, n - len(a[:n]))) for a in (state['last'], arr)]
+        # day d has lag L in prev when (lag0 - 1) - d = L
+        lags = lag0 - 1 - np.arange(n)
+        ok = lags < len(state['num'])
+        np.add.at(state['num'], lags[ok], cur[ok])
+        np.add.at(state['den'], lags[ok], prev[ok])
+        np.add.at(state['pairs'], lags[ok], 1)
+    state['last'] = arr
+    state['last_date'] = date
+
+def completeness(state, fallback, min_pairs, min_den):
+    # Return an array whose element x is the fraction of the final count of a
+    # day reported x days after it, x = 0 .. max_lag. The estimated growth of a
+    # lag is only trusted once min_pairs pairs of snapshots, with a count of at
+    # least min_den at that lag in total, were compared. The other lags grow
+    # like the fallback array (same shape as the result), which is returned as
+    # is while no lag can be trusted. If fallback is None, None is returned
+    # until every lag can be trusted.
+    ok = (state['pairs'] >= min_pairs) & (state['den'] >= min_den)
+    if not ok.any() or (fallback is None and not ok.all()):
+        return fallback
+    if fallback is None:
+        factors = np.ones(len(ok))
+    else:
+        # growth from lag L to L + 1 according to the fallback (infinite from a fraction of 0)
+        with np.errstate(divide='ignore'):
+            factors = fallback[1:] / fallback[:-1]
+    factors[ok] = state['num'][ok] / state['den'][ok]
+    # fraction reported at lag L is the inverse of the growth from L to max_lag
+    growth = np.cumprod(factors[::-1])[::-1]
+    frac = np.append(1 / growth, 1.0)
+    return np.clip(frac, 1e-3, 1.0)
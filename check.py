@@ -0,0 +1,316 @@
+#!/usr/bin/python3
+#
+# Checks that the scripts still produce the same numbers, and that they are not
+# getting slower or using more memory.
+#
+#   $ ./check.py -record [snapshot ...]
+#   $ ./check.py [snapshot ...]
+#
+# -record saves the outputs, run time and peak memory of every stage on the
+# given snapshots (by default all of those in data_fdoh) to golden_file. Stages
+# run the code paths of the main() of the scripts. Without -record, the outputs
+# are compared to the saved ones, and the run time and memory to the budgets
+# derived from the saved ones. The outputs are also compared to those of the
+# scripts as they were before they were optimized (see reference.py), which are
+# slow: check a few snapshots rather than all of them. The exit status is 1 if
+# any check fails.
+
+import sys, os, gc, math, json, time, datetime, resource
+import concurrent.futures, multiprocessing
+import numpy as np
+import linelist
+import snapshot_archive
+import case_backfill
+import reference
+import age_stratified_cfr, forecast_deaths, heatmap, gamma
+
+golden_file = 'data_fdoh/golden.json'
+# Tolerance when comparing numbers to the saved ones
+rel_tol = 1e-6
+abs_tol = 1e-9
+# A stage fails if it takes more than time_slack times the saved run time (plus
+# time_grace seconds, for timing noise), or if the memory it allocates on top of
+# the imported modules is more than memory_slack times the saved one (plus
+# memory_grace MB)
+time_slack = 1.5
+time_grace = 1.0
+memory_slack = 1.25
+memory_grace = 10
+
+def key2str(k):
+    if isinstance(k, tuple):
+        return '-'.join(str(x) for x in k)
+    return str(k)
+
+def jsonable(obj):
+    # Convert the outputs of the scripts to what json.dump() accepts
+    if isinstance(obj, dict):
+        return {key2str(k): jsonable(v) for (k, v) in obj.items()}
+    if isinstance(obj, (list, tuple, np.ndarray)):
+        return [jsonable(x) for x in obj]
+    if isinstance(obj, datetime.date):
+        return obj.isoformat()
+    if isinstance(obj, np.generic):
+        obj = obj.item()
+    if isinstance(obj, float) and not math.isfinite(obj):
+        return str(obj)
+    return obj
+
+def compare(path, expected, actual, errors):
+    # Append to errors the differences between expected and actual
+    if isinstance(expected, dict) and isinstance(actual, dict):
+        for k in sorted(set(expected) | set(actual)):
+            if k not in actual or k not in expected:
+                errors.append(f'{path}/{k}: only in {"saved" if k in expected else "new"} outputs')
+            else:
+                compare(f'{path}/{k}', expected[k], actual[k], errors)
+    elif isinstance(expected, list) and isinstance(actual, list):
+        if len(expected) != len(actual):
+            errors.append(f'{path}: length {len(actual)} instead of {len(expected)}')
+        for (i, (e, a)) in enumerate(zip(expected, actual)):
+            compare(f'{path}/{i}', e, a, errors)
+    elif isinstance(expected, (int, float)) and isinstance(actual, (int, float)) and \
+            not isinstance(expected, bool):
+        if not math.isclose(expected, actual, rel_tol=rel_tol, abs_tol=abs_tol):
+            errors.append(f'{path}: {actual} instead of {expected}')
+    elif expected != actual:
+        errors.append(f'{path}: {actual!r} instead of {expected!r}')
+    # do not report more than a screenful of differences
+    del errors[20:]
+
+#
+# Stages. Each one returns the outputs of a script on the snapshots fnames.
+#
+
+def stage_load(fnames):
+    df = linelist.load(fnames[-1])
+    known = df['Age'] != linelist.unknown_age
+    return {
+            'rows': len(df),
+            'deaths': df['Died'].sum(),
+            'unknown_age': (~known).sum(),
+            'age_sum': df['Age'][known].astype(int).sum(),
+            'by_county': df['County'].value_counts().sort_index().to_dict(),
+            }
+
+def backfill_of(fnames):
+    # The completeness of cases estimated by case_backfill.py on the snapshots
+    state = case_backfill.new_state()
+    case_backfill.process(state, fnames)
+    return case_backfill.completeness(state)
+
+def cfr_outputs(data):
+    # the CFR table of age_stratified_cfr.print_stats(), and the last long-term adjusted CFRs
+    table = {date: {bracket: counters[bracket].cfr_raw for bracket in age_stratified_cfr.age_brackets}
+            for (date, counters) in data.items()}
+    last = data[max(data)]
+    return {
+            'cfr_raw': table,
+            'cfr_adjusted_long': {b: last[b].cfr_adjusted_long for b in last},
+            }
+
+def stage_cfr(fnames):
+    return cfr_outputs(age_stratified_cfr.analyze(linelist.load(fnames[-1]), backfill=backfill_of(fnames),
+            date_of_data=linelist.snapshot_date(fnames[-1])))
+
+def heatmap_outputs(cases_per_bracket, ages, share_positive, cases_per_capita):
+    # the table of heatmap.print_stats(), and the other heatmaps
+    return {
+            'cases_per_bracket': cases_per_bracket,
+            'median_age': {period: np.median(a) for (period, a) in ages.items()},
+            'share_positive': share_positive,
+            'cases_per_capita': cases_per_capita,
+            }
+
+def stage_heatmap(fnames):
+    return heatmap_outputs(*heatmap.analyze(linelist.load(fnames[-1])))
+
+def forecast_outputs(deaths):
+    return {model.model_no: deaths[i] for (i, model) in enumerate(forecast_deaths.cfr_models)}
+
+def stage_forecast(fnames):
+    return forecast_outputs(forecast_deaths.forecast(linelist.load(fnames[-1]), backfill=backfill_of(fnames),
+            date_of_data=linelist.snapshot_date(fnames[-1])))
+
+def stage_gamma(fnames):
+    (counters, o2d_all) = (None, [])
+    for fname in fnames:
+        counters = gamma.accumulate(fname, gamma.parse(fname), counters, o2d_all)
+    result = {}
+    for (bracket, (o2d, shape, loc, scale)) in gamma.fit(o2d_all).items():
+        result[bracket] = {'deaths': len(o2d)}
+        if len(o2d):
+            result[bracket].update(mean=shape * scale, shape=shape)
+    return result
+
+stages = {
+        'load': stage_load,
+        'cfr': stage_cfr,
+        'heatmap': stage_heatmap,
+        'forecast': stage_forecast,
+        'gamma': stage_gamma,
+        }
+
+def max_rss():
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def run_stage(name, fnames):
+    # Run in a new process, so that the peak memory is the one of this stage.
+    # Most of it is taken by the imported modules, so only the growth of the
+    # peak memory during the stage is measured.
+    gc.collect()
+    before = max_rss()
+    t = time.perf_counter()
+    outputs = jsonable(stages[name](fnames))
+    seconds = time.perf_counter() - t
+    return outputs, seconds, max_rss() - before
+
+#
+# Comparisons with the reference implementations, and equivalence of fast
+# paths. Each check returns a list of differences.
+#
+
+def check_cfr(fnames):
+    errors = []
+    expected = reference.cfr(fnames[-1])
+    actual = age_stratified_cfr.analyze(linelist.load(fnames[-1]))
+    brackets = list(age_stratified_cfr.age_brackets) + [age_stratified_cfr.OVERALL]
+    attrs = ('cases', 'deaths', 'cfr_raw', 'cfr_adjusted_short', 'cfr_adjusted_long')
+    def table(data):
+        return jsonable({date: {b: {a: getattr(counters[b], a) for a in attrs} for b in brackets}
+            for (date, counters) in data.items()})
+    compare('cfr', table(expected), table(actual), errors)
+    return errors
+
+def check_heatmap(fnames):
+    errors = []
+    compare('heatmap', jsonable(heatmap_outputs(*reference.heatmap_analyze(fnames[-1]))),
+            jsonable(stage_heatmap(fnames)), errors)
+    return errors
+
+def check_forecast(fnames):
+    errors = []
+    expected = reference.forecast(fnames[-1])
+    compare('forecast', jsonable(forecast_outputs(expected)),
+            jsonable(forecast_outputs(forecast_deaths.forecast(linelist.load(fnames[-1])))), errors)
+    return errors
+
+def check_gamma(fnames):
+    errors = []
+    expected = {b: v for (b, v) in reference.gamma_fit(reference.gamma_o2d(fnames)).items()}
+    compare('gamma', jsonable(expected), jsonable(stage_gamma(fnames)), errors)
+    return errors
+
+def check_archive(fnames):
+    index = snapshot_archive.load_index()
+    errors = []
+    for fname in fnames:
+        if os.path.basename(fname) not in index['snapshots']:
+            continue
+        a = snapshot_archive.load(fname, index)
+        b = linelist.load(fname)
+        if 'blocks' in index['snapshots'][os.path.basename(fname)]:
+            # archived sorted by EventDate
+            b = b.iloc[np.argsort(b['EventDate'].to_numpy(), kind='stable')].reset_index(drop=True)
+        for col in linelist.columns:
+            if not a[col].astype(object).equals(b[col].astype(object)):
+                errors.append(f'archive/{os.path.basename(fname)}/{col}: differs from the CSV')
+    return errors
+
+def check_anchored(fnames):
+    # Counts updated snapshot by snapshot, and counted from scratch on the last one
+    state = heatmap.new_state()
+    for fname in fnames:
+        heatmap.update(state, linelist.load(fname))
+    df = linelist.load(fnames[-1])
+    full = heatmap.new_state()
+    heatmap.update(full, df)
+    if not np.array_equal(state['counts'], full['counts']):
+        return ['anchored: incremental counts differ from a full recount']
+    # and the cases by period and age bracket are those of the anchored periods
+    # of the rows
+    period = heatmap.periods_of(df, anchored=True)
+    age = df['Age'].to_numpy()
+    expected = {}
+    for p in set(period[period != linelist.unknown_date].tolist()):
+        in_period = period == p
+        expected[linelist.to_date(p)] = {(low, high): (in_period & (age >= low) & (age <= high)).sum()
+                for (low, high) in heatmap.buckets_ages}
+    errors = []
+    compare('anchored', jsonable(expected), jsonable(heatmap.analyze_counts(state['counts'])[0]), errors)
+    return errors
+
+def check_window(fnames):
+    # CFRs of the last days calculated from the rows read from the archive for
+    # these days only, and from the whole snapshot
+    days = 7
+    full = age_stratified_cfr.analyze(linelist.load(fnames[-1]))
+    errors = []
+    for (date, counters) in age_stratified_cfr.recent(fnames[-1], days).items():
+        for bracket in list(age_stratified_cfr.age_brackets) + [age_stratified_cfr.OVERALL]:
+            for attr in ('cases', 'deaths', 'cfr_raw', 'cfr_adjusted_short', 'cfr_adjusted_long'):
+                compare(f'window/{date}/{key2str(bracket)}/{attr}', jsonable(getattr(full[date][bracket], attr)),
+                        jsonable(getattr(counters[bracket], attr)), errors)
+    return errors
+
+checks = {
+        'cfr': check_cfr,
+        'heatmap': check_heatmap,
+        'forecast': check_forecast,
+        'gamma': check_gamma,
+        'archive': check_archive,
+        'anchored': check_anchored,
+        'window': check_window,
+        }
+
+def main():
+    record = len(sys.argv) > 1 and sys.argv[1] == '-record'
+    if record:
+        sys.argv.pop(1)
+    fnames = sys.argv[1:] if len(sys.argv) > 1 else linelist.snapshots()
+    if len(fnames) < 2:
+        raise Exception('Need at least 2 line list snapshots')
+    golden = {}
+    if not record:
+        golden = json.load(open(golden_file))
+        if golden['snapshots'] != [os.path.basename(f) for f in fnames]:
+            raise Exception(f'{golden_file} was recorded on other snapshots: {golden["snapshots"]}')
+    results = {}
+    failed = False
+    ctx = multiprocessing.get_context('spawn')
+    for name in stages:
+        with concurrent.futures.ProcessPoolExecutor(1, mp_context=ctx) as executor:
+            (outputs, seconds, memory) = executor.submit(run_stage, name, fnames).result()
+        results[name] = {'outputs': outputs, 'seconds': seconds, 'memory': memory}
+        print(f'Stage {name}: {seconds:.2f}s, {memory:.0f} MB', end='')
+        if record:
+            print('')
+            continue
+        saved = golden['stages'][name]
+        errors = []
+        compare(name, saved['outputs'], outputs, errors)
+        if seconds > saved['seconds'] * time_slack + time_grace:
+            errors.append(f'{name}: took {seconds:.2f}s, budget is {saved["seconds"] * time_slack + time_grace:.2f}s')
+        if memory > saved['memory'] * memory_slack + memory_grace:
+            errors.append(f'{name}: used {memory:.0f} MB, budget is {saved["memory"] * memory_slack + memory_grace:.0f} MB')
+        print(' FAILED' if errors else ' OK')
+        for e in errors:
+            print(f'  {e}')
+        failed |= bool(errors)
+    for (name, check) in checks.items():
+        errors = check(fnames)
+        print(f'Check {name}:', 'FAILED' if errors else 'OK')
+        for e in errors[:20]:
+            print(f'  {e}')
+        failed |= bool(errors)
+    if record and not failed:
+        tmp = golden_file + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'snapshots': [os.path.basename(f) for f in fnames], 'stages': results}, f, indent=1)
+        os.replace(tmp, golden_file)
+        print(f'Saved {golden_file}')
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
@@ -2,36 +2,56 @@
 #
 # Forecasts Florida COVID-19 deaths from line list case data and CFR stratified by age.
 
-import sys, os, math, datetime, json
+import sys, datetime
+import concurrent.futures
 import pandas as pd
 import numpy as np
+import scipy.stats as stats
 import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
 import matplotlib.ticker as ticker
-from matplotlib import rcParams
-
-# Florida COVID-19 line list data. CSV found at:
-# https://www.arcgis.com/home/item.html?id=4cc62b3a510949c7a8167f6baa3e069d
-csv_url = 'https://www.arcgis.com/sharing/rest/content/items/4cc62b3a510949c7a8167f6baa3e069d/data'
+import linelist
+import reporting_delay
+import case_backfill
+import render
 
 # Observed deaths, by date reported
 csv_deaths_reported = 'data_deaths/fl_resident_deaths.csv'
 
 # Observed deaths, by date death occurred
-csv_deaths_occurred = 'data_deaths/deaths_by_date_of_death.csv'
+csv_deaths_occurred = reporting_delay.csv_deaths_occurred
 
 # Do not chart last 2 days of deaths by date of death (data is incomplete)
 deaths_occurred_ignore_days = 2
 
-# Mean time (in days) from onset of symptoms to death, calculated by gamma.py
+# Mean time (in days) from onset of symptoms to death, and shape of its Gamma
+# distribution, calculated by gamma.py
 o2d = 25.1
+o2d_shape = 1.97
+
+# Monte Carlo simulation (-simulate): number of replicates, seed, replicates
+# simulated at a time, and quantiles of the prediction intervals
+sim_replicates = 20000
+sim_seed = 0
+sim_chunk = 100
+sim_quantiles = (.05, .5, .95)
+
+# Fitting of a CFR model to observed deaths (-fit): the CFR of each age bracket
+# of model 5 and an extra delay from death to report (one of fit_delays days)
+# maximize the Poisson likelihood of the deaths reported from fit_first_date on,
+# after fit_iterations iterations of multiplicative (EM) updates. The deaths of
+# the brackets are mostly explained by the same days, so the likelihood alone can
+# push a bracket to 0% or 100%: a weak prior counts, in every bracket, as
+# fit_prior_cases extra cases dying at the CFR of model 5, and the CFR of a
+# bracket is capped at the CFR of the older brackets.
+fit_iterations = 5000
+fit_delays = range(15)
+fit_first_date = datetime.date(2020, 4, 1)
+fit_prior_cases = 1000
 
 # Number of days to calculate the simple moving average of the chart curves
 avg_days = 7
 
-datadir = 'data_fdoh'
-opts = {}
-
 # Each instance represents one model of age-stratified Case Fatality Ratios
 class CFRModel():
     def __init__(self, model_no, source, cfr_average, cfr_by_age):
@@ -121,12 +141,9 @@ cfr_models = [
             ),
         ]
 
-def parse_date(s):
-    return datetime.datetime.strptime(s, '%Y-%m-%d').date()
-
 def cfr_for_age(model, age):
     # Given a patient age, return the Case Fatality Ratio for their age
-    if math.isnan(age) or age < 0:
+    if age == linelist.unknown_age:
         # For patients whose age is unknown (less than 1% of all cases),
         # assume the average CFR
         return model.cfr_average
@@ -135,6 +152,12 @@ def cfr_for_age(model, age):
             return cfr
     raise Exception(f'Could not find IFR for age {age} in model {model.source}')
 
+def cfr_by_age(model):
+    # Return an array of the CFR of every age 0..max_age, followed by the CFR
+    # of patients whose age is unknown
+    ages = list(range(linelist.max_age + 1)) + [linelist.unknown_age]
+    return np.array([cfr_for_age(model, a) for a in ages])
+
 def forecast_deaths(model, ages):
     # Given a list of patient ages, return the expected number of deaths.
     return sum([cfr_for_age(model, a) for a in ages])
@@ -150,8 +173,7 @@ def sma(arr, avg_days=avg_days):
         i += 1
     return arr2
 
-def init_chart(date_of_data):
-    rcParams['figure.titlesize'] = 'x-large'
+def init_chart(date_of_data, region='Florida'):
     (fig, ax) = plt.subplots(dpi=300)#, figsize=(6.4, 6.4)) # default is 6.4 × 4.8
     ax.xaxis.set_minor_locator(ticker.MultipleLocator(base=1))
     ax.xaxis.set_major_locator(ticker.MultipleLocator(base=7)) # tick every 7 days
@@ -170,13 +192,17 @@ def init_chart(date_of_data):
         'Created by: Marc Bevand — @zorinaq',
         transform=ax.transAxes, fontsize='x-small', verticalalignment='top',
     )
-    fig.suptitle(f'Forecast of daily COVID-19 deaths in Florida\n(as of {date_of_data})')
+    fig.suptitle(f'Forecast of daily COVID-19 deaths in {region}\n(as of {date_of_data})', fontsize='x-large')
     return (fig, ax)
 
-def gen_chart(date_of_data, fig, ax, deaths, deaths_reported, deaths_occurred, deaths_occurred_adj, deaths_best_guess):
+def gen_chart(date_of_data, deaths, deaths_reported, deaths_occurred, deaths_occurred_adj, deaths_best_guess,
+        filename, redline=False, bands=None, region='Florida', models=cfr_models):
+    # deaths_reported, deaths_occurred, deaths_occurred_adj and deaths_best_guess
+    # are empty when observed deaths are not known for the region
+    (fig, ax) = init_chart(date_of_data, region)
     # plot observed deaths, by date reported
     d = deaths_reported
-    if 'redline' in opts:
+    if redline:
         # when line list is published on date_of_data, observed deaths are known up to 1 day prior
         truncate = date_of_data - datetime.timedelta(days=1)
         split = list(filter(lambda x: x[1][0] == truncate, enumerate(d)))[0][0]
@@ -187,29 +213,44 @@ def gen_chart(date_of_data, fig, ax, deaths, deaths_reported, deaths_occurred, d
         first_legend = ax.legend(handles=[hndl], loc=(.1, .7), fontsize='small',
                 labels=['Observed deaths that occurred\nafter forecast was made'])
         fig.gca().add_artist(first_legend)
-    ax.plot([x[0] for x in d], [x[1] for x in d], linewidth=1.5, color=(0, 0, 0, 0.7),
-            label=f'Observed deaths by date reported on COVID-19 dashboard ({avg_days}-day SMA)')
-    ax.fill_between([x[0] for x in d], [x[1] for x in d], color=(0, 0, 0, 0.10))
+    if d:
+        ax.plot([x[0] for x in d], [x[1] for x in d], linewidth=1.5, color=(0, 0, 0, 0.7),
+                label=f'Observed deaths by date reported on COVID-19 dashboard ({avg_days}-day SMA)')
+        ax.fill_between([x[0] for x in d], [x[1] for x in d], color=(0, 0, 0, 0.10))
     # plot observed deaths, by date death occurred
     d = deaths_occurred
-    ax.plot([x[0] for x in d], [x[1] for x in d], linewidth=.75, color=(0, 0, 0, 0.7),
-            label=f'Observed deaths by exact date of death ("Deaths by Day", {avg_days}-day SMA); '
-            f'last {deaths_occurred_ignore_days} days not charted due to incomplete data')
+    if d:
+        ax.plot([x[0] for x in d], [x[1] for x in d], linewidth=.75, color=(0, 0, 0, 0.7),
+                label=f'Observed deaths by exact date of death ("Deaths by Day", {avg_days}-day SMA); '
+                f'last {deaths_occurred_ignore_days} days not charted due to incomplete data')
     d = deaths_occurred_adj
-    ax.plot([x[0] for x in d], [x[1] for x in d], linewidth=.75, color=(0, 0, 0, 0.7), ls=(0, (12, 2)),
-            label=f'Observed deaths by exact date of death, adjusted for incomplete data')
+    if d:
+        ax.plot([x[0] for x in d], [x[1] for x in d], linewidth=.75, color=(0, 0, 0, 0.7), ls=(0, (12, 2)),
+                label=f'Observed deaths by exact date of death, adjusted for incomplete data')
     # plot best guess
     d = deaths_best_guess
-    ax.fill_between([x[0] for x in d], [x[1] for x in d], [x[2] for x in d],
-            color='black', alpha=0.10, hatch='\\' * 5, label=f'Forecast of deaths by date reported (best guess)')
+    if d:
+        ax.fill_between([x[0] for x in d], [x[1] for x in d], [x[2] for x in d],
+                color='black', alpha=0.10, hatch='\\' * 5, label=f'Forecast of deaths by date reported (best guess)')
     # plot forecasts
     lstyles = ('dashed', 'dashdot', (0, (1, 0.7)))
     for (i, d) in enumerate(deaths):
         if i == 0:
             last_forecast = d[-1][0]
-        ax.plot([x[0] for x in d], [x[1] for x in d], linewidth=1.0, ls=lstyles[i % len(lstyles)],
-                label=f'Forecast model {cfr_models[i].model_no}: {cfr_models[i].source}')
+        label = f'Forecast model {models[i].model_no}: {models[i].source}'
+        if bands:
+            label += f'\n(shaded: {(sim_quantiles[-1] - sim_quantiles[0]) * 100:.0f}% prediction interval)'
+        hndl, = ax.plot([x[0] for x in d], [x[1] for x in d], linewidth=1.0, ls=lstyles[i % len(lstyles)],
+                label=label)
+        if bands:
+            b = bands[i]
+            ax.fill_between([x[0] for x in b], [x[1] for x in b], [x[-1] for x in b],
+                    color=hndl.get_color(), alpha=0.15, linewidth=0)
     # chart
+    if not deaths_reported:
+        # the fixed ticks of init_chart() are too sparse for the deaths of a single county
+        ax.yaxis.set_major_locator(ticker.AutoLocator())
+        ax.yaxis.set_minor_locator(ticker.AutoMinorLocator())
     ax.set_ylim(bottom=0)
     ax.set_xlim(left=datetime.date(2020, 3, 16), right=last_forecast)
     # make "best guess" the first legend entry
@@ -218,9 +259,9 @@ def gen_chart(date_of_data, fig, ax, deaths, deaths_reported, deaths_occurred, d
     order = [order[-1]] + order[:-1]
     ax.legend([handles[idx] for idx in order], [labels[idx] for idx in order],
         fontsize='xx-small', bbox_to_anchor=(1, -0.25), frameon=False, handlelength=5)
-    fig.savefig('forecast_deaths.png', bbox_inches='tight')
+    fig.savefig(filename, bbox_inches='tight')
 
-def best_guess(date_of_data, deaths_forecasts, deaths_reported):
+def best_guess(date_of_data, deaths_forecasts, deaths_reported, models=cfr_models):
     # when line list is published on date_of_data, observed deaths are known up to 1 day prior
     date_of_data -= datetime.timedelta(days=1)
     # find deaths observed on date_of_data
@@ -229,8 +270,8 @@ def best_guess(date_of_data, deaths_forecasts, deaths_reported):
             deaths_target = deaths
             break
     # find model 5 (our model) in deaths_forecasts:
-    for (i, _) in enumerate(cfr_models):
-        if cfr_models[i].model_no == '5':
+    for (i, _) in enumerate(models):
+        if models[i].model_no == '5':
             model_5 = deaths_forecasts[i]
     # find model 5 prediction for the last day on which deaths were observed
     for date, deaths in model_5:
@@ -253,20 +294,14 @@ def best_guess(date_of_data, deaths_forecasts, deaths_reported):
                 adj_factor_max *= 1 + epsilon
     return best_guess
 
-def occurred():
-    print(f'Opening {csv_deaths_occurred}')
-    result = []
-    for feature in json.load(open(csv_deaths_occurred))['features']:
-        attrs = feature['attributes']
-        date = datetime.datetime.utcfromtimestamp(attrs['Date'] / 1e3).date()
-        deaths = attrs['Deaths']
-        # occasionally we see bogus rows with dates from years ago. ignore them
-        if date >= datetime.date(2020, 1, 1):
-            result.append((date, deaths))
-    # result is usually already sorted in csv_deaths_occurred, but sort it to guarantee it
-    result = sorted(result)
+def occurred(fname=csv_deaths_occurred, state=None):
+    print(f'Opening {fname}')
+    result = reporting_delay.parse(fname)
     adj_last = 60 # adjust starting this many days prior to the present day
     assert len(result) > adj_last
+    # frac[x] is the fraction of total deaths that are reported x days after the
+    # death, fitted by reporting_delay.py on archived snapshots of csv_deaths_occurred
+    frac = reporting_delay.completeness(state)
     deaths_occurred = result[:-deaths_occurred_ignore_days]
     deaths_occurred_adj = []
     for date, deaths in result[-adj_last:-deaths_occurred_ignore_days]:
@@ -275,53 +310,34 @@ def occurred():
         # Ideally we should keep track of when csv_deaths_occurred was published instead of
         # making this assumption.
         x = (result[-1][0] - date).days + 1
-        # The CDF of death reporting (1 - e^(-lamda*x)) gives the approximate fraction
-        # of total deaths that are reported x days after the death, see:
-        # https://github.com/mbevand/florida-covid19-deaths-by-day/blob/master/README.md#average-reporting-delay
-        lamda = 0.1428
-        frac_reported = 1 - math.e**(-lamda * x)
+        frac_reported = frac[min(x, len(frac) - 1)]
         deaths_occurred_adj.append((date, deaths / frac_reported))
     return sma(deaths_occurred), sma(deaths_occurred_adj)
 
-def main():
-    if len(sys.argv) > 1 and sys.argv[1] == '-redline':
-        # ignore. author's custom switch to make redline charts updating my first forecast
-        # https://twitter.com/zorinaq/status/1279934357323386880
-        opts['redline'] = True
-        sys.argv.pop(0)
-    if len(sys.argv) > 1:
-        fname = sys.argv[1]
-    else:
-        try:
-            files = list(filter(lambda x: x.endswith('.csv') or x.endswith('.csv.gz'), sorted(os.listdir(datadir))))
-        except FileNotFoundError:
-            files = []
-        if files:
-            fname = datadir + os.sep + files[-1]
-        else:
-            fname = csv_url
-    print(f'Opening {fname}')
-    df = pd.read_csv(fname)
+def forecast(df, models=cfr_models, backfill=None, date_of_data=None):
+    # backfill is the completeness of cases by lag estimated by case_backfill.py:
+    # if given, the forecast deaths of the last days of onset are scaled up by the
+    # cases still to be reported for these days. Their lag is counted from the
+    # day of data of the snapshot, the day prior to date_of_data (from the last
+    # day of onset of df if date_of_data is not given: the last day of onset of
+    # a county may be days before the day of data).
     # We estimate deaths based on the mean onset-to-death time, so we must work from EventDate.
-    df['date_parsed'] = pd.to_datetime(
-            # Timestamps are formatted as "2020/06/28 05:00:00+00". We truncate
-            # after the whitespace to ignore the time.
-            df['EventDate'].apply(lambda x: x.split(' ')[0]), format='%Y/%m/%d'
-    )
-    last_day = sorted(set(df['date_parsed']))[-1].date()
-    first_day = sorted(set(df['date_parsed']))[0].date()
-    # assume the filename starts with YYYY-MM-DD
-    date_of_data = parse_date(os.path.basename(fname)[:10])
-    (fig, ax) = init_chart(date_of_data)
+    df = df[df['EventDate'] != linelist.unknown_date]
+    ages_by_day = {d: list(ages) for (d, ages) in df.groupby('EventDate')['Age']}
+    first_day = linelist.to_date(min(ages_by_day))
+    last_day = linelist.to_date(max(ages_by_day))
+    data_day = last_day if date_of_data is None else date_of_data - datetime.timedelta(days=1)
     # deaths[N] is an array of daily deaths forecasted by model "N"
-    deaths = [[] for i in range(len(cfr_models))]
+    deaths = [[] for i in range(len(models))]
     day = first_day
     while day <= last_day:
-        ages = list(df[df['date_parsed'] == pd.Timestamp(day)]['Age'])
+        ages = ages_by_day.get(linelist.to_days(day), [])
         future_day = day + datetime.timedelta(days=np.round(o2d))
-        for (i, model) in enumerate(cfr_models):
+        for (i, model) in enumerate(models):
             f = forecast_deaths(model, ages)
-            if day == last_day:
+            if backfill is not None:
+                f *= case_backfill.adjustment(backfill, (data_day - day).days)
+            elif day == last_day:
                 # line list data is almost always incomplete for the last day (FDOH doesn't
                 # refresh the file at midnight), so heuristically the forecast deaths for
                 # the last day are forced to be at least equal to the day prior
@@ -330,10 +346,101 @@ def main():
         day += datetime.timedelta(days=1)
     for i in range(len(deaths)):
         deaths[i] = sma(deaths[i])
+    return deaths
+
+def cases_by_day(df):
+    # Return the first day of onset, and the number of cases by day of onset and
+    # age (the last column counting the cases whose age is unknown)
+    df = df[df['EventDate'] != linelist.unknown_date]
+    first = df['EventDate'].min()
+    day = df['EventDate'].to_numpy().astype(int) - first
+    age = np.where(df['Age'] == linelist.unknown_age, linelist.max_age + 1, df['Age'])
+    cases = np.zeros((day.max() + 1, linelist.max_age + 2), dtype=np.int64)
+    np.add.at(cases, (day, age), 1)
+    return linelist.to_date(first), cases
+
+def delay_table(size=1 << 16):
+    # Inverse CDF of the onset-to-death Gamma distribution, rounded to days:
+    # indexing it with uniform 16-bit random integers samples onset-to-death
+    # times much faster than drawing from the Gamma distribution
+    rv = stats.gamma(o2d_shape, scale=o2d / o2d_shape)
+    return np.rint(rv.ppf((np.arange(size) + .5) / size)).astype(np.int64)
+
+def simulate_chunk(cases, cfr, table, replicates, seed):
+    # Simulate replicates of the daily deaths caused by cases (by day of onset
+    # and by group of ages of same CFR): each case dies with probability cfr,
+    # after an onset-to-death time drawn from table
+    rng = np.random.default_rng(seed)
+    days = len(cases)
+    # deaths by replicate and day of onset. Drawing all the replicates of a cell
+    # one after the other is faster: numpy caches the setup of the binomial
+    deaths = rng.binomial(cases[..., None], cfr[:, None], size=cases.shape + (replicates,)).sum(axis=1).T
+    result = np.empty((replicates, days), dtype=np.int64)
+    onset = np.arange(days)
+    # one replicate at a time, so that the deaths and their histogram stay in
+    # the CPU cache
+    for (r, n) in enumerate(deaths):
+        # day of onset of every death, then day of death. Each raw 64-bit output
+        # of the generator makes 4 uniform 16-bit indexes, and take() is much
+        # faster than indexing with an array.
+        death = np.repeat(onset, n)
+        index = rng.bit_generator.random_raw((len(death) + 3) // 4).view(np.uint16)[:len(death)]
+        death += table.take(index)
+        result[r] = np.bincount(death, minlength=days + int(table[-1]) + 1)[:days]
+    return result
+
+def simulate(df, replicates=sim_replicates, seed=sim_seed, processes=1, models=cfr_models, backfill=None,
+        date_of_data=None):
+    # Return, for each model, the prediction intervals of the daily deaths
+    # (N-day SMA) as a list of (date, low, median, high) for the sim_quantiles.
+    # Results only depend on the seed, not on the number of processes.
+    (first_day, cases) = cases_by_day(df)
+    table = delay_table()
+    if backfill is not None:
+        # cases still to be reported for the last days (see forecast())
+        lag = np.arange(len(cases))[::-1]
+        if date_of_data is not None:
+            last_day = first_day + datetime.timedelta(days=len(cases) - 1)
+            lag += (date_of_data - datetime.timedelta(days=1) - last_day).days
+        cases = np.rint(cases * case_backfill.adjustment(backfill, lag)[:, None]).astype(np.int64)
+    elif len(cases) >= 2 and cases[-1].sum() < cases[-2].sum():
+        # the last day is almost always incomplete (see forecast()): simulate it
+        # with the cases of the day prior if it has less
+        cases[-1] = cases[-2]
+    seeds = np.random.SeedSequence(seed).spawn((replicates + sim_chunk - 1) // sim_chunk)
+    sizes = [min(sim_chunk, replicates - i * sim_chunk) for i in range(len(seeds))]
+    executor = concurrent.futures.ProcessPoolExecutor(processes) if processes != 1 else None
+    bands = []
+    for model in models:
+        # ages of same CFR are simulated together
+        (cfr, group) = np.unique(cfr_by_age(model), return_inverse=True)
+        grouped = np.zeros((len(cases), len(cfr)), dtype=np.int64)
+        for (g, col) in zip(group, cases.T):
+            grouped[:, g] += col
+        # deaths near the end of the forecast are mostly caused by cases whose onset
+        # is after the last day: assume they occur at the average rate of the last days
+        future = np.rint(grouped[-avg_days:].mean(axis=0)).astype(np.int64)
+        grouped = np.vstack([grouped] + [future] * int(np.round(o2d)))
+        args = ([grouped] * len(seeds), [cfr] * len(seeds), [table] * len(seeds), sizes, seeds)
+        chunks = list(executor.map(simulate_chunk, *args) if executor else map(simulate_chunk, *args))
+        daily = np.concatenate(chunks)
+        # N-day SMA of each replicate, first day of the first full window onwards
+        c = np.cumsum(daily, axis=1, dtype=np.float64)
+        avg = (c[:, avg_days - 1:] - np.pad(c, ((0, 0), (1, 0)))[:, :-avg_days]) / avg_days
+        q = np.quantile(avg, sim_quantiles, axis=0)
+        bands.append([(first_day + datetime.timedelta(days=i + avg_days - 1), *q[:, i]) for i in range(avg.shape[1])])
+    if executor:
+        executor.shutdown()
+    return bands
+
+def reported(fname=csv_deaths_reported):
+    return sma(reported_daily(fname))
+
+def reported_daily(fname=csv_deaths_reported):
     # get observed deaths, by date reported
     deaths_reported = []
-    print(f'Opening {csv_deaths_reported}')
-    df = pd.read_csv(csv_deaths_reported)
+    print(f'Opening {fname}')
+    df = pd.read_csv(fname)
     df['date'] = pd.to_datetime(df['date'], format='%Y-%m-%d')
     cumulative_deaths = 0
     for (_, row) in df[df['state'] == 'Florida'].iterrows():
@@ -342,13 +449,145 @@ def main():
         deaths_reported.append((row['date'].date() - datetime.timedelta(days=1),
             row['deaths'] - cumulative_deaths))
         cumulative_deaths = row['deaths']
-    deaths_reported = sma(deaths_reported)
-    # get observed deaths, by date death occurred
-    deaths_occurred, deaths_occurred_adj = occurred()
-    # calculate best guess forecast
-    deaths_best_guess = best_guess(date_of_data, deaths, deaths_reported)
-    # generate chart
-    gen_chart(date_of_data, fig, ax, deaths, deaths_reported, deaths_occurred, deaths_occurred_adj, deaths_best_guess)
+    return deaths_reported
+
+def cases_by_bracket(df, brackets):
+    # Return the first day of onset, and the number of cases by day of onset and
+    # age bracket. Cases whose age is unknown are spread across brackets like
+    # the cases of known age of the same day.
+    (first_day, cases) = cases_by_day(df)
+    hist = np.zeros((len(cases), len(brackets)))
+    for (j, (low, high)) in enumerate(brackets):
+        hist[:, j] = cases[:, low:min(high, linelist.max_age) + 1].sum(axis=1)
+    known = hist.sum(axis=1, keepdims=True)
+    share = np.divide(hist, known, out=np.full_like(hist, 1 / len(brackets)), where=known > 0)
+    return first_day, hist + share * cases[:, -1:]
+
+def design(hist, delays):
+    # Return X such that X[D] @ cfr is the expected number of deaths by day
+    # (from the first day of onset) if the CFR of the brackets is cfr, and if
+    # deaths are reported D days after they occur
+    rv = stats.gamma(o2d_shape, scale=o2d / o2d_shape)
+    k = np.arange(int(np.ceil(rv.ppf(.999))) + 1)
+    # probability that onset-to-death rounds to k days
+    pmf = rv.cdf(k + .5) - rv.cdf(np.maximum(k - .5, 0))
+    days = len(hist) + len(pmf) + max(delays)
+    x0 = np.zeros((days, hist.shape[1]))
+    for j in range(hist.shape[1]):
+        x0[:len(hist) + len(pmf) - 1, j] = np.convolve(hist[:, j], pmf)
+    x = np.zeros((len(delays),) + x0.shape)
+    for (i, delay) in enumerate(delays):
+        x[i, delay:] = x0[:days - delay]
+    return x
+
+def fit_poisson(x, y, prior, prior_cases=fit_prior_cases, iterations=fit_iterations):
+    # Return the CFR vectors maximizing the Poisson likelihood of observing the
+    # deaths y given the expected deaths x[D] @ cfr, for every D at once (the
+    # candidate vectors are evaluated as one batched matrix product), and the
+    # log-likelihood of each. The CFRs are pulled towards prior as if each
+    # bracket had prior_cases more cases dying at the CFR prior (a Gamma prior,
+    # whose log-density is included in the log-likelihood). The brackets are
+    # sorted by age.
+    norm = x.sum(axis=1)
+    cfr = np.ones(norm.shape) * prior
+    for _ in range(iterations):
+        mu = np.matmul(x, cfr[..., None])[..., 0]
+        ratio = np.divide(y, mu, out=np.zeros_like(mu), where=mu > 0)
+        cfr = (cfr * np.matmul(ratio[:, None, :], x)[:, 0, :] + prior_cases * prior) / (norm + prior_cases)
+        # a CFR can not exceed 100%, nor the CFR of an older bracket
+        np.minimum(cfr, 1, out=cfr)
+        cfr = np.minimum.accumulate(cfr[:, ::-1], axis=1)[:, ::-1]
+    mu = np.matmul(x, cfr[..., None])[..., 0]
+    loglik = (y * np.log(np.maximum(mu, 1e-300)) - mu).sum(axis=1)
+    loglik += (prior_cases * (prior * np.log(np.maximum(cfr, 1e-300)) - cfr)).sum(axis=1)
+    return cfr, loglik
+
+def fit(df, date_of_data, deaths_reported=None, models=cfr_models):
+    # Return a new CFRModel whose CFR by age bracket (those of model 5) best
+    # explains the deaths reported up to date_of_data, and the extra delay
+    if deaths_reported is None:
+        deaths_reported = reported_daily()
+    model5 = [m for m in models if m.model_no == '5'][0]
+    brackets = list(model5.cfr_by_age)
+    (first_day, hist) = cases_by_bracket(df, brackets)
+    x = design(hist, fit_delays)
+    # observed deaths by day from first_day, fitted from fit_first_date up to the
+    # day prior to date_of_data
+    y = np.zeros(x.shape[1])
+    fitted = np.zeros(x.shape[1], dtype=bool)
+    for (date, deaths) in deaths_reported:
+        i = (date - first_day).days
+        if date >= fit_first_date and date < date_of_data and 0 <= i < len(y):
+            # corrections may make the daily deaths negative
+            y[i] = max(deaths, 0)
+            fitted[i] = True
+    (cfr, loglik) = fit_poisson(x[:, fitted], y[fitted], np.array(list(model5.cfr_by_age.values())))
+    best = np.argmax(loglik)
+    cfr = cfr[best]
+    if fit_delays[best] == max(fit_delays) or (fit_delays[best] == min(fit_delays) and fit_delays[best] > 0):
+        # the likelihood may keep increasing past the delays tried: the delay
+        # only means that the best one is at least (or at most) this
+        print(f'Warning: the fitted delay of {fit_delays[best]} days is at the limit of the delays tried '
+                f'({min(fit_delays)} to {max(fit_delays)} days), widen fit_delays')
+    cases = hist.sum(axis=0)
+    model = CFRModel('fit', f'CFR by age bracket fitted to the observed deaths by date reported\n'
+            f'(Poisson likelihood, deaths reported {fit_delays[best]} days after they occur)',
+            cases @ cfr / cases.sum(), dict(zip(brackets, cfr)))
+    return model, fit_delays[best]
+
+def model_source(model):
+    # Return the Python source of model, to add it to cfr_models
+    lines = ['CFRModel(', f'    {model.model_no!r},']
+    source = model.source.split('\n')
+    lines += ['    ' + repr(line + '\n') for line in source[:-1]] + [f'    {source[-1]!r},']
+    lines.append(f'    {100 * model.cfr_average:.3f} / 100, {{')
+    lines += [f'        {bracket}: {100 * cfr:.3f} / 100,' for (bracket, cfr) in model.cfr_by_age.items()]
+    lines += ['        }', '    ),']
+    return '\n'.join(' ' * 8 + line for line in lines)
+
+def charts(date_of_data, deaths, redline=False, bands=None, prefix='', region='Florida', observed=True,
+        models=cfr_models):
+    # observed is False when the observed deaths (which are statewide) do not apply to the region
+    deaths_reported, deaths_occurred, deaths_occurred_adj, deaths_best_guess = [], [], [], []
+    if observed:
+        deaths_reported = reported()
+        # get observed deaths, by date death occurred
+        deaths_occurred, deaths_occurred_adj = occurred()
+        # calculate best guess forecast
+        deaths_best_guess = best_guess(date_of_data, deaths, deaths_reported, models)
+    filename = f'{prefix}forecast_deaths.png'
+    return [render.Chart(filename, gen_chart, date_of_data, deaths, deaths_reported, deaths_occurred,
+        deaths_occurred_adj, deaths_best_guess, filename, redline=redline, bands=bands, region=region,
+        models=models)]
+
+def main():
+    opts = {}
+    while len(sys.argv) > 1 and sys.argv[1] in ('-redline', '-simulate', '-fit'):
+        # -redline: ignore. author's custom switch to make redline charts updating my first forecast
+        # https://twitter.com/zorinaq/status/1279934357323386880
+        # -simulate: chart the prediction intervals of a Monte Carlo simulation of the models
+        # -fit: fit the CFR of each age bracket to the observed deaths, and chart it as a new model
+        opts[sys.argv.pop(1)[1:]] = True
+    fname = sys.argv[1] if len(sys.argv) > 1 else linelist.latest()
+    print(f'Opening {fname}')
+    df = linelist.load(fname)
+    # assume the filename starts with YYYY-MM-DD
+    date_of_data = linelist.snapshot_date(fname)
+    # correct the last days of onset for backfill, if enough snapshots were
+    # processed by case_backfill.py
+    backfill = case_backfill.completeness()
+    models = cfr_models
+    if 'fit' in opts:
+        (model, delay) = fit(df, date_of_data)
+        print(f'Fitted CFR (deaths reported {delay} days after they occur):')
+        print(model_source(model))
+        models = cfr_models + [model]
+    bands = None
+    if 'simulate' in opts:
+        print(f'Simulating {sim_replicates} replicates')
+        bands = simulate(df, processes=None, models=models, backfill=backfill, date_of_data=date_of_data)
+    deaths = forecast(df, models=models, backfill=backfill, date_of_data=date_of_data)
+    render.render(charts(date_of_data, deaths, redline='redline' in opts, bands=bands, models=models))
 
 if __name__ == '__main__':
     main()
@@ -2,27 +2,19 @@
 #
 # Fit onset-to-death times in a Gamma distribution
 
-import sys, datetime, os
+import sys
 import numpy as np
 import scipy.stats as stats
-import pandas as pd
 import matplotlib.pyplot as plt
 import matplotlib.ticker as ticker
+import linelist
+import snapdiff
+import snapshot_archive
+import render
 
 debug = False
 age_brackets = ((0, 29), (30, 39), (40, 49), (50, 59), (60, 69), (70, 79), (80, 89), (90, np.inf), (0, np.inf))
 
-def parse_date(s, fmt='%Y-%m-%d'):
-    return datetime.datetime.strptime(s, fmt).date()
-
-def normalize_date(s):
-    for fmt in ('%Y-%m-%d', '%Y/%m/%d', '%m/%d/%Y'):
-        try:
-            return str(parse_date(s, fmt=fmt))
-        except ValueError:
-            pass
-    raise Exception(f'Could not parse date "{s}"')
-
 def bracket2str(bracket):
     if bracket == (0, np.inf):
         return 'All ages'
@@ -33,53 +25,28 @@ def bracket2str(bracket):
 
 def parse(fname):
     print(f'Parsing {fname}')
-    # Bucketize deaths by the characteristics of their patients (age, gender, county...)
-    counters = {}
-    df = pd.read_csv(fname)
-    for _, row in df.iterrows():
-        if row['Died'] != 'Yes':
-            continue
-        # Dates follow one of these formats:
-        # "2020/06/28 05:00:00+00", or
-        # "2020/06/28 05:00:00", or
-        # "2020-04-18 00:00:00", or
-        # "07/18/2020 5:00"
-        # We truncate after the whitespace to ignore the time, and normalize the date to YYYY-MM-DD
-        chartdate = normalize_date(row['ChartDate'].split(' ')[0]) # Date the case was counted
-        eventdate = normalize_date(row['EventDate'].split(' ')[0]) # Date of onset
-        characteristics = (
-                # Age MUST be first becuase main() accesses it at a fixed index
-                row['Age'],
-                row['County'],
-                row['Gender'],
-                row['Jurisdiction'],
-                chartdate,
-                eventdate,
-                # EventDate MUST be last because calc_o2d() accesses it at a fixed index
-                )
-        if characteristics not in counters:
-            counters[characteristics] = 0
-        counters[characteristics] += 1
+    return snapshot_archive.load(fname)
+
+def count(df):
+    # Index deaths by the characteristics of their patients (age, gender, county...)
+    # Deaths whose date of onset is unknown can not give an onset-to-death time
+    counters = snapdiff.index(df[df['Died'] & (df['EventDate'] != linelist.unknown_date)])
     if debug:
         # This printout shows that most deaths can be uniquely identified
         # with their characteristics (ie. most bucket counters are 1)
+        seen = np.bincount(counters['counts'], minlength=51)
         for counter in range(1, 51):
-            n = len(list(filter(lambda x: x == counter, counters.values())))
-            print(f'{n} rows have characteristics seen {counter} times')
+            print(f'{seen[counter]} rows have characteristics seen {counter} times')
     return counters
 
-def calc_o2d(fname, characteristics):
-    # Filename must start with "YYYY-MM-DD" which represents the date the
-    # FDOH line list was downloaded, and contains data for the day prior
-    death_reported = parse_date(os.path.basename(fname)[:10]) - datetime.timedelta(days=1)
-    # Parse EventDate (last element of the characteristics tuple)
-    onset = parse_date(characteristics[-1])
-    # Calculate onset-to-death
-    o2d = (death_reported - onset).days
-    assert o2d >= 0
-    return o2d
+def calc_o2d(fname, onset):
+    # The FDOH line list downloaded on the date of the snapshot contains data for the day prior
+    death_reported = linelist.to_days(linelist.snapshot_date(fname)) - 1
+    # onset (EventDate) is in days since linelist.epoch. It may be the day of the
+    # download, giving an onset-to-death time of -1 day that fit() discards
+    return death_reported - onset.astype(int)
 
-def gen_chart(o2d, bracket, shape, loc, scale):
+def gen_chart(o2d, bracket, shape, loc, scale, filename):
     fig, ax = plt.subplots(dpi=300)
     y, _ = np.histogram(o2d, bins=max(o2d) - min(o2d) + 1)
     x = range(min(o2d), max(o2d) + 1)
@@ -105,42 +72,67 @@ def gen_chart(o2d, bracket, shape, loc, scale):
         'Created by: Marc Bevand — @zorinaq',
         transform=ax.transAxes, fontsize='x-small', verticalalignment='top',
     )
-    fig.savefig(f'gamma_{bracket[0]}-{bracket[1]}.png', bbox_inches='tight')
+    fig.savefig(filename, bbox_inches='tight')
     plt.close()
 
-def main():
-    fnames = sys.argv[1:]
-    if len(fnames) < 2:
-        raise Exception('Need at least 2 line list CSV files')
-    counters = []
-    for fname in fnames:
-        counters.append(parse(fname))
-    o2d_all = []
-    for (i, _) in enumerate(counters):
-        if i == 0:
-            continue
-        for characteristics in counters[i].keys():
-            age = characteristics[0]
-            # Count the number of new deaths reported on this day
-            new_deaths = counters[i][characteristics] - \
-                     counters[i - 1].get(characteristics, 0)
-            o = calc_o2d(fnames[i], characteristics)
-            o2d_all.extend([(o, age)] * new_deaths)
+def new_deaths(fname, counters, prev_counters):
+    # Return the (onset-to-death, age) of the deaths that appeared in the snapshot
+    # fname, given its counters and those of the snapshot of the day prior
+    (added, _) = snapdiff.diff(prev_counters, counters)
+    new = snapdiff.rows(added)
+    o2d = calc_o2d(fname, new['EventDate'])
+    return list(zip(o2d.tolist(), new['Age'].tolist()))
+
+def accumulate(fname, df, prev_counters, o2d_all):
+    # Count the deaths of the snapshot fname (loaded as df), and append to o2d_all
+    # the (onset-to-death, age) of those that appeared since the snapshot of the
+    # day prior, whose counters are prev_counters (None if there is none). Return
+    # the counters of fname, to pass as prev_counters for the next snapshot.
+    counters = count(df)
+    if prev_counters is not None:
+        o2d_all.extend(new_deaths(fname, counters, prev_counters))
+    return counters
+
+def fit(o2d_all):
+    # Return the onset-to-death times and the params of their Gamma distribution by age bracket
     # Ignore onset-to-death times of 0 days, because these are likely cases where
-    # the date of onset was not known and filled out with the date of death
+    # the date of onset was not known and filled out with the date of death, and
+    # negative ones (onset on the day of the download)
     o2d_all = list(filter(lambda x: x[0] > 0, o2d_all))
+    result = {}
     for bracket in age_brackets:
-        print(f'\n{bracket2str(bracket)}:')
         # get the onset-to-death times only for the specific age bracket
         o2d = [x[0] for x in list(filter(lambda x: x[1] >= bracket[0] and x[1] <= bracket[1], o2d_all))]
-        #print(f'Onset-to-death times (in days): {o2d}')
-        print(f'Number of deaths: {len(o2d)}')
         if len(o2d):
             # Fit in a Gamma distribution. Note that we fix the location to 0.
             shape, loc, scale = stats.gamma.fit(o2d, floc=0)
+            result[bracket] = (o2d, shape, loc, scale)
+        else:
+            result[bracket] = (o2d, None, None, None)
+    return result
+
+def report(params):
+    # Print the numerical summary and return the charts of the Gamma distributions
+    charts = []
+    for (bracket, (o2d, shape, loc, scale)) in params.items():
+        print(f'\n{bracket2str(bracket)}:')
+        #print(f'Onset-to-death times (in days): {o2d}')
+        print(f'Number of deaths: {len(o2d)}')
+        if len(o2d):
             print(f'Gamma distribution params:\nmean = {shape * scale:.1f}\nshape = {shape:.2f}')
             print(f'Median: {np.median(o2d):.1f}')
-            gen_chart(o2d, bracket, shape, loc, scale)
+            filename = f'gamma_{bracket[0]}-{bracket[1]}.png'
+            charts.append(render.Chart(filename, gen_chart, o2d, bracket, shape, loc, scale, filename))
+    return charts
+
+def main():
+    fnames = sys.argv[1:]
+    if len(fnames) < 2:
+        raise Exception('Need at least 2 line list CSV files')
+    (counters, o2d_all) = (None, [])
+    for fname in fnames:
+        counters = accumulate(fname, parse(fname), counters, o2d_all)
+    render.render(report(fit(o2d_all)))
 
 if __name__ == "__main__":
     main()
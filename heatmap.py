@@ -3,25 +3,28 @@
 # Analyzes Florida COVID-19 line list data by age bracket over time.
 
 import sys
-import math
 import os
+import math
 import datetime
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 import matplotlib.ticker as ticker
 import seaborn as sns
-from matplotlib import rcParams
 from PIL import Image
+import linelist
+import render
 
-# Florida COVID-19 line list data. CSV found at:
-# https://www.arcgis.com/home/item.html?id=4cc62b3a510949c7a8167f6baa3e069d
-csv_url = 'https://www.arcgis.com/sharing/rest/content/items/4cc62b3a510949c7a8167f6baa3e069d/data'
 buckets_days = 7
+# In anchored mode (-anchored), periods start every buckets_days days from this
+# date instead of ending on the last date in the dataset, and the number of cases
+# by day and age is kept in state_file so that a new snapshot only needs to
+# recount the days that changed
+anchor = linelist.epoch
+state_file = 'data_fdoh/heatmap_counts.npz'
 buckets_ages = [(0, 4), (5, 9), (10, 14), (15, 19), (20, 24), (25, 29), (30, 34), (35, 39), (40, 44), (45, 49), (50, 54), (55, 59), (60, 64), (65, 69), (70, 74), (75, 79), (80, 84), (85, math.inf), ]
 #buckets_ages = [(0, 9), (10, 19), (20, 29), (30, 39), (40, 49), (50, 59), (60, 69), (70, 79), (80, 89), (90, math.inf), ]
 #buckets_ages = [(i, i) for i in range(100)] + [(100,math.inf)]
-datadir = 'data_fdoh'
 
 def per_1000(bucket, n):
     # Given an age bracket and a number of residents in this age bracket,
@@ -58,7 +61,7 @@ def bracket2str(bracket):
         return f'{bracket[0]:02d}-{bracket[1]:02d}'
     return f'{bracket[0]}'
 
-def print_stats(cases_per_bracket, ages, df):
+def print_stats(cases_per_bracket, medians, df):
     print(
         f"Number of COVID-19 cases per {buckets_days}-day time period in Florida by age "
         "bracket over time:"
@@ -71,22 +74,21 @@ def print_stats(cases_per_bracket, ages, df):
         print(f"{str(period):>12},", end="")
         for bucket in buckets_ages:
             print(f" {cases_per_bracket[period][bucket]:5d},", end="")
-        print(f"  {np.median(ages[period]):.1f}")
+        print(f"  {medians[period]:.1f}")
     cases_total = len(df)
-    cases_age_unknown = df["Age"].isnull().sum()
+    cases_age_unknown = (df["Age"] == linelist.unknown_age).sum()
     print(
         f"(Last period's data may be incomplete. Age unknown for {cases_age_unknown} out of "
         f"{cases_total} cases.)"
     )
 
-def gen_heatmap(cases_per_bracket, filename, comment='', sqrt=False, title='', cm='inferno', clabel=''):
+def gen_heatmap(cases_per_bracket, filename, comment='', sqrt=False, title='', cm='inferno', clabel='', region='Florida'):
     def conv(val):
         if sqrt:
             # Square root makes the heat map brighter (by dampening the highest values).
             return np.sqrt(val)
         else:
             return val
-    rcParams["figure.titlesize"] = "x-large"
     (fig, ax) = plt.subplots(dpi=300)
     periods = sorted(cases_per_bracket.keys())
     def fmt_dates(x, pos=None):
@@ -123,10 +125,10 @@ def gen_heatmap(cases_per_bracket, filename, comment='', sqrt=False, title='', c
         transform=ax.transAxes,
         verticalalignment="top",
     )
-    fig.suptitle(f"Heatmap Of COVID-19 Cases In Florida\nBy Age Over Time{title}")
+    fig.suptitle(f"Heatmap Of COVID-19 Cases In {region}\nBy Age Over Time{title}", fontsize="x-large")
     img = ax.imshow(a, cmap=cm, origin="lower", interpolation="nearest", aspect="auto")
     if sqrt:
-        if filename == 'heatmap_per_capita':
+        if filename.endswith('heatmap_per_capita'):
             ticks = list(range(100)) + [0.5]
         else:
             ticks = [0, 20] + [i * 10**e for e in range(2, 5) for i in (1, 2, 5)]
@@ -137,8 +139,9 @@ def gen_heatmap(cases_per_bracket, filename, comment='', sqrt=False, title='', c
     cbar.set_label(clabel)
     plt.savefig(f"{filename}.png", bbox_inches="tight")
 
-def gen_gif(df):
-    non_null = df[~df["Age"].isnull()]
+def gen_gif(df, anchored=False):
+    df = df.assign(Period=periods_of(df, anchored))
+    non_null = df[(df["Age"] != linelist.unknown_age) & (df["Period"] != linelist.unknown_date)]
     periods = list(set(non_null["Period"]))
     periods.sort()
     max_cases = 0
@@ -161,7 +164,7 @@ def gen_gif(df):
                 label.set_visible(False)
         plt.ylim(0, max_cases)
         plt.xlim(0, max_age)
-        plt.title(str(period))
+        plt.title(str(linelist.to_date(period)))
         canvas = plt.get_current_fig_manager().canvas
         canvas.draw()
         pil_image = Image.frombytes(
@@ -173,42 +176,22 @@ def gen_gif(df):
         "cases_ages.gif", save_all=True, append_images=images[1:], duration=350, loop=0
     )
 
-def main():
-    if len(sys.argv) > 1:
-        fname = sys.argv[1]
-    else:
-        try:
-            files = list(filter(lambda x: x.endswith('.csv') or x.endswith('.csv.gz'), sorted(os.listdir(datadir))))
-        except FileNotFoundError:
-            files = []
-        if files:
-            fname = datadir + os.sep + files[-1]
-        else:
-            fname = csv_url
-    print(f'Opening {fname}')
-    df = pd.read_csv(fname)
+def periods_of(df, anchored=False):
+    # Return the start of the time period of every case, in days since linelist.epoch.
     # We show cases by date reported (ChartDate)
-    # The timestamp can follow one of 3 formats:
-    # "2020/06/28 05:00:00+00", or
-    # "2020/06/28 05:00:00", or
-    # "07/18/2020 5:00"
-    # We truncate after the whitespace to ignore the time and try to parse YYYY/MM/DD or MM/DD/YYYY
-    try:
-        df["date_parsed"] = pd.to_datetime(
-                df["ChartDate"].apply(lambda x: x.split(' ')[0]), format="%Y/%m/%d"
-        )
-    except ValueError:
-        df["date_parsed"] = pd.to_datetime(
-                df["ChartDate"].apply(lambda x: x.split(' ')[0]), format="%m/%d/%Y"
-        )
+    chartdate = df['ChartDate'].astype(int)
+    known = chartdate != linelist.unknown_date
     # Pick a reference point in time to align the time periods. The date one day past the
     # last date in the dataset is the best choice because it aligns the last period so it
-    # ends on, and includes, the last date in the dataset.
-    reference = sorted(set(df['date_parsed']))[-1].date() + datetime.timedelta(days=1)
-    df["Delta"] = df["date_parsed"].apply(lambda date: (date.date() - reference).days)
-    df["Period"] = df["Delta"].apply(
-        lambda delta: reference + datetime.timedelta(days=delta - delta % buckets_days)
-    )
+    # ends on, and includes, the last date in the dataset. Anchored periods start
+    # every buckets_days days from anchor instead, like those of analyze_counts().
+    reference = linelist.to_days(anchor) if anchored else chartdate[known].max() + 1
+    delta = chartdate - reference
+    return np.where(known, reference + delta - delta % buckets_days, linelist.unknown_date)
+
+def analyze(df):
+    # df is not modified, so that it can be shared by concurrent calls
+    df = df.assign(Period=periods_of(df))
     # cases_per_bracket[datetime.date(y, m, d)][(low_age, high_age)] is the number of
     # cases for the period of time starting on datetime.date(y, m, d) in the age bracket
     # low_age to high_age.
@@ -216,26 +199,31 @@ def main():
     # ages[datetime.date(y, m, d)]] is the list of case ages for the period of time
     # starting on datetime.date(y, m, d).
     ages = {}
-    non_null = df[~df["Age"].isnull()]
-    periods = set(df["Period"])
+    non_null = df[df["Age"] != linelist.unknown_age]
+    periods = set(linelist.to_date(p) for p in set(df["Period"]) if p != linelist.unknown_date)
     for period in periods:
         cases_per_bracket[period] = {bucket: 0 for bucket in buckets_ages}
         ages[period] = []
-        in_period = non_null["Period"] == period
+        in_period = non_null["Period"] == linelist.to_days(period)
         for bucket in buckets_ages:
             (low_age, high_age) = bucket
             in_age_bucket = (low_age <= non_null["Age"]) & (non_null["Age"] <= high_age)
             in_period_and_age = in_period & in_age_bucket
             cases_per_bracket[period][bucket] = in_period_and_age.sum()
             ages[period].extend(list(non_null[in_period_and_age]["Age"]))
+    share_positive, cases_per_capita = derive(cases_per_bracket)
+    return cases_per_bracket, ages, share_positive, cases_per_capita
+
+def derive(cases_per_bracket):
+    # Return share_positive and cases_per_capita calculated from cases_per_bracket
     # calculate share_positive
     share_positive = {}
     for (period, cases_data) in cases_per_bracket.items():
         total_cases = sum(cases_data.values())
         share_positive[period] = {}
         for (bucket, cases) in cases_data.items():
-            share_positive[period][bucket] = 100 * cases / total_cases
-    for period in periods:
+            share_positive[period][bucket] = 100 * cases / total_cases if total_cases else 0
+    for period in cases_per_bracket:
         # there were so few cases before this date that the age brackets with the
         # highest percentages of cases have such high percentages that a few pixels
         # in the heatmap are going to be very bright, and all the others very dim.
@@ -248,15 +236,119 @@ def main():
         cases_per_capita[period] = {}
         for (bucket, cases) in cases_data.items():
             cases_per_capita[period][bucket] = per_1000(bucket, cases)
+    return share_positive, cases_per_capita
+
+def new_state():
+    return {
+            # counts[D][A] is the number of cases reported D days after anchor aged A
+            # (the last column counts the cases whose age is unknown)
+            'counts': np.zeros((0, linelist.max_age + 2), dtype=np.int32),
+            # digests[D] identifies the ages of the cases reported D days after anchor
+            'digests': np.zeros(0, dtype=np.uint64),
+            }
+
+def load_state():
+    if not os.path.exists(state_file):
+        return new_state()
+    npz = np.load(state_file)
+    return {k: npz[k] for k in ('counts', 'digests')}
+
+def save_state(state):
+    tmp = state_file + '.tmp.npz'
+    np.savez(tmp, counts=state['counts'], digests=state['digests'])
+    os.replace(tmp, state_file)
+
+def update(state, df):
+    # Update the counts of the state with the snapshot df, recounting only the
+    # days whose cases changed. Return the number of days recounted.
+    day = df['ChartDate'].to_numpy().astype(np.int64) - linelist.to_days(anchor)
+    # widened first, max_age + 1 does not fit in the int8 ages
+    age = df['Age'].to_numpy().astype(np.int64)
+    age[age == linelist.unknown_age] = linelist.max_age + 1
+    reported = (df['ChartDate'].to_numpy() != linelist.unknown_date) & (day >= 0)
+    (day, age) = (day[reported], age[reported])
+    days = day.max() + 1 if len(day) else 0
+    # the digest of a day is the sum of the hashes of the ages of its cases, so it
+    # does not depend on the order of the rows
+    digests = np.zeros(days, dtype=np.uint64)
+    np.add.at(digests, day, pd.util.hash_array(age))
+    old = np.zeros(days, dtype=np.uint64)
+    n = min(days, len(state['digests']))
+    old[:n] = state['digests'][:n]
+    changed = np.flatnonzero(digests != old)
+    counts = np.zeros((days, linelist.max_age + 2), dtype=np.int32)
+    counts[:n] = state['counts'][:n]
+    counts[changed] = 0
+    recount = np.isin(day, changed)
+    np.add.at(counts, (day[recount], age[recount]), 1)
+    state['counts'] = counts
+    state['digests'] = digests
+    return len(changed)
+
+def median_age(hist):
+    # Return the median of the ages whose histogram is hist
+    cum = np.cumsum(hist)
+    n = cum[-1]
+    if not n:
+        return math.nan
+    return (np.searchsorted(cum, (n - 1) // 2, side='right') + np.searchsorted(cum, n // 2, side='right')) / 2
+
+def analyze_counts(counts):
+    # Same as analyze(), from the counts of a state, except that the median age of
+    # each period is returned instead of the list of ages
+    periods = -(-len(counts) // buckets_days)
+    padded = np.zeros((periods * buckets_days, counts.shape[1]), dtype=np.int64)
+    padded[:len(counts)] = counts
+    by_period = padded.reshape(periods, buckets_days, -1).sum(axis=1)
+    cases_per_bracket = {}
+    medians = {}
+    for (i, hist) in enumerate(by_period):
+        if not hist.any():
+            continue
+        period = anchor + datetime.timedelta(days=i * buckets_days)
+        known = hist[:linelist.max_age + 1]
+        cases_per_bracket[period] = {}
+        for bucket in buckets_ages:
+            (low_age, high_age) = bucket
+            cases_per_bracket[period][bucket] = known[low_age:int(min(high_age, linelist.max_age)) + 1].sum()
+        medians[period] = median_age(known)
+    share_positive, cases_per_capita = derive(cases_per_bracket)
+    return cases_per_bracket, medians, share_positive, cases_per_capita
+
+def charts(cases_per_bracket, share_positive, cases_per_capita, prefix='', region='Florida'):
+    # cases_per_capita is None when the population of the region is unknown
+    result = [
+        render.Chart(f'{prefix}heatmap.png', gen_heatmap, cases_per_bracket, f'{prefix}heatmap', sqrt=True,
+            clabel='Number of cases', comment='number of cases reported', region=region),
+        render.Chart(f'{prefix}heatmap_age_share.png', gen_heatmap, share_positive, f'{prefix}heatmap_age_share',
+            cm='viridis', clabel='Percentage of cases', title=' (Percentage)',
+            comment='percentage of cases in the age bracket\namong all cases in the time period', region=region),
+        ]
+    if cases_per_capita is not None:
+        result.append(render.Chart(f'{prefix}heatmap_per_capita.png', gen_heatmap, cases_per_capita,
+            f'{prefix}heatmap_per_capita', sqrt=True, cm='cividis', clabel='Number of cases per 1000 residents',
+            title=' (Per Capita)', comment='number of cases reported per capita', region=region))
+    return result
+
+def main():
+    anchored = len(sys.argv) > 1 and sys.argv[1] == '-anchored'
+    if anchored:
+        sys.argv.pop(1)
+    fname = sys.argv[1] if len(sys.argv) > 1 else linelist.latest()
+    print(f'Opening {fname}')
+    df = linelist.load(fname)
+    if anchored:
+        state = load_state()
+        print(f'Recounted {update(state, df)} days')
+        save_state(state)
+        cases_per_bracket, medians, share_positive, cases_per_capita = analyze_counts(state['counts'])
+    else:
+        cases_per_bracket, ages, share_positive, cases_per_capita = analyze(df)
+        medians = {period: np.median(a) for (period, a) in ages.items()}
     # print stats and generate charts
-    print_stats(cases_per_bracket, ages, df)
-    gen_gif(df)
-    gen_heatmap(cases_per_bracket, 'heatmap', sqrt=True, clabel='Number of cases',
-            comment='number of cases reported')
-    gen_heatmap(share_positive, 'heatmap_age_share', cm='viridis', clabel='Percentage of cases',
-            title=' (Percentage)', comment='percentage of cases in the age bracket\namong all cases in the time period')
-    gen_heatmap(cases_per_capita, 'heatmap_per_capita', sqrt=True, cm='cividis', clabel='Number of cases per 1000 residents',
-            title=' (Per Capita)', comment='number of cases reported per capita')
+    print_stats(cases_per_bracket, medians, df)
+    gen_gif(df, anchored)
+    render.render(charts(cases_per_bracket, share_positive, cases_per_capita))
 
 if __name__ == "__main__":
     main()
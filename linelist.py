@@ -0,0 +1,256 @@
+# Locates and loads the FDOH line list snapshots archived in data_fdoh.
+
+import os, io, json, datetime, threading, queue, zlib
+import numpy as np
+import pandas as pd
+try:
+    # Intel ISA-L inflates about twice as fast as zlib
+    from isal import isal_zlib as inflate_zlib
+except ImportError:
+    inflate_zlib = zlib
+
+# Florida COVID-19 line list data. CSV found at:
+# https://www.arcgis.com/home/item.html?id=4cc62b3a510949c7a8167f6baa3e069d
+csv_url = 'https://www.arcgis.com/sharing/rest/content/items/4cc62b3a510949c7a8167f6baa3e069d/data'
+datadir = 'data_fdoh'
+
+# Columns loaded by load(). The other columns are not used by our scripts.
+columns = ['County', 'Age', 'Gender', 'Jurisdiction', 'Died', 'EventDate', 'ChartDate']
+# Dates are stored as the number of days since this date
+epoch = datetime.date(2020, 1, 1)
+# Value of Age when the age is unknown, negative (on 2020-08-07 a case was added
+# with Age=-1.0) or too large to be a plausible age, see validate()
+unknown_age = -1
+max_age = 127
+# Value of EventDate and ChartDate when the date is unknown or invalid, see validate()
+unknown_date = np.iinfo(np.int16).min
+# When asked to, load() copies the rows with invalid values (see validate()) to
+# this subdirectory of the directory of the snapshot: <snapshot> holds the rows
+# and <snapshot>.json the number of rows breaking each rule
+quarantine_dir = 'quarantine'
+
+# Gzipped snapshots are read in blocks of this size, and at most this many
+# decompressed blocks are buffered ahead of the CSV parser
+block_size = 1 << 20
+buffered_blocks = 16
+
+def snapshots(datadir=datadir):
+    # Return the paths of all snapshots, oldest first
+    try:
+        files = list(filter(lambda x: x.endswith('.csv') or x.endswith('.csv.gz'), sorted(os.listdir(datadir))))
+    except FileNotFoundError:
+        files = []
+    return [datadir + os.sep + f for f in files]
+
+def latest(datadir=datadir):
+    # Return the path of the latest snapshot, or if there is none the URL to download it
+    files = snapshots(datadir)
+    return files[-1] if files else csv_url
+
+def snapshot_date(fname):
+    # Filenames start with "YYYY-MM-DD" which represents the date the FDOH line list
+    # was downloaded (it contains data for the day prior)
+    return datetime.datetime.strptime(os.path.basename(fname)[:10], '%Y-%m-%d').date()
+
+def to_date(days):
+    return epoch + datetime.timedelta(days=int(days))
+
+def to_days(date):
+    return (date - epoch).days
+
+def parse_dates(s):
+    # Convert a categorical column of timestamps to days since epoch. Only the
+    # categories are parsed: there are a few hundred of them for 100k's of rows.
+    # Dates follow one of these formats:
+    # "2020/06/28 05:00:00+00", or
+    # "2020/06/28 05:00:00", or
+    # "2020-04-18 00:00:00", or
+    # "07/18/2020 5:00"
+    # We truncate after the whitespace to ignore the time.
+    dates = pd.Series(s.cat.categories.astype(str)).str.split(' ').str[0]
+    parsed = pd.to_datetime(dates, format='%Y/%m/%d', errors='coerce')
+    for fmt in ('%Y-%m-%d', '%m/%d/%Y'):
+        parsed = parsed.fillna(pd.to_datetime(dates, format=fmt, errors='coerce'))
+    days = ((parsed - pd.Timestamp(epoch)) / pd.Timedelta(days=1)).to_numpy()
+    bad = np.isnan(days) | (days <= unknown_date) | (days > np.iinfo(np.int16).max)
+    days = np.where(bad, unknown_date, days).astype(np.int16)
+    # missing values have the code -1, which picks the last element
+    return np.append(days, np.int16(unknown_date))[s.cat.codes.to_numpy()]
+
+def parse_ages(s):
+    # Convert a categorical column of ages to float32, NaN if missing or not a
+    # number. Only the categories are parsed, like in parse_dates().
+    ages = pd.to_numeric(pd.Series(s.cat.categories.astype(str)), errors='coerce').to_numpy(np.float32)
+    # missing values have the code -1, which picks the last element
+    return np.append(ages, np.float32(np.nan))[s.cat.codes.to_numpy()]
+
+class Inflater(io.RawIOBase):
+    # Reads a gzip file decompressed by a thread, so that decompression overlaps
+    # with parsing (zlib and ISA-L release the GIL while they decompress)
+    def __init__(self, fname):
+        self.queue = queue.Queue(buffered_blocks)
+        self.buf = bytearray()
+        self.eof = False
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self.inflate, args=(fname,), daemon=True)
+        self.thread.start()
+
+    def inflate(self, fname):
+        try:
+            with open(fname, 'rb') as f:
+                # 16 + MAX_WBITS expects a gzip header
+                d = inflate_zlib.decompressobj(16 + zlib.MAX_WBITS)
+                while not self.stop.is_set():
+                    block = f.read(block_size)
+                    if not block:
+                        break
+                    data = d.decompress(block)
+                    # a gzip file may consist of multiple members
+                    while d.eof and d.unused_data:
+                        rest = d.unused_data
+                        d = inflate_zlib.decompressobj(16 + zlib.MAX_WBITS)
+                        data += d.decompress(rest)
+                    self.put(data)
+                if not d.eof and not self.stop.is_set():
+                    raise EOFError(f'{fname} is truncated')
+            self.put(None)
+        except Exception as e:
+            self.put(e)
+
+    def put(self, item):
+        # give up if the reader was closed, instead of blocking on a full queue forever
+        while not self.stop.is_set():
+            try:
+                self.queue.put(item, timeout=.1)
+                return
+            except queue.Full:
+                pass
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.buf and not self.eof:
+            item = self.queue.get()
+            if item is None:
+                self.eof = True
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                self.buf += item
+        n = min(len(b), len(self.buf))
+        b[:n] = self.buf[:n]
+        del self.buf[:n]
+        return n
+
+    def close(self):
+        self.stop.set()
+        super().close()
+
+def open_snapshot(fname):
+    # Return what to pass to pd.read_csv() to read the snapshot fname
+    if fname.endswith('.gz') and os.path.exists(fname):
+        # with zlib on a single core, the thread only adds overhead to the
+        # decompression done by pandas itself
+        if inflate_zlib is zlib and os.cpu_count() == 1:
+            return fname
+        return io.BufferedReader(Inflater(fname), block_size)
+    return fname
+
+def validate(df, age, dates, download_day):
+    # Classify the invalid values of a snapshot in one vectorized pass. Return a
+    # dict mapping (column, rule) to the mask of the rows breaking the rule. An
+    # invalid value is replaced by the unknown value of its column, so the row
+    # still counts as a case. download_day is the day the snapshot was downloaded.
+    rules = {
+            ('Age', 'unparsable'): np.isnan(age) & df['Age'].notna().to_numpy(),
+            ('Age', 'negative'): age < 0,
+            ('Age', 'too large'): age > max_age,
+            }
+    for (col, days) in dates.items():
+        known = days != unknown_date
+        # unparsable, or too far from epoch for an int16
+        rules[(col, 'unparsable')] = ~known & df[col].notna().to_numpy()
+        rules[(col, 'before epoch')] = known & (days < 0)
+        # a case can not be dated after the snapshot was downloaded (cases dated
+        # on the day of the download are valid, although the snapshot has data
+        # for the day prior)
+        rules[(col, 'after snapshot')] = known & (days > download_day)
+    return rules
+
+def quarantine(fname, df, rules):
+    # Copy the rows of df breaking rules to quarantine_dir and record their counts
+    counts = {f'{col} {rule}': int(mask.sum()) for ((col, rule), mask) in rules.items() if mask.any()}
+    if not os.path.exists(fname):
+        # downloaded from csv_url
+        return
+    qdir = os.path.join(os.path.dirname(fname), quarantine_dir)
+    name = os.path.basename(fname)
+    counts_file = os.path.join(qdir, name + '.json')
+    try:
+        try:
+            if json.load(open(counts_file)) == counts:
+                # already quarantined
+                return
+        except (FileNotFoundError, ValueError):
+            pass
+        os.makedirs(qdir, exist_ok=True)
+        if counts:
+            bad = np.logical_or.reduce(list(rules.values()))
+            print(f'Quarantined {bad.sum()} rows of {fname}:', ', '.join(f'{k}: {n}' for (k, n) in counts.items()))
+            rows = df[bad].copy()
+            rows['Rules'] = [', '.join(f'{col} {rule}' for ((col, rule), mask) in rules.items() if mask[i])
+                    for i in np.flatnonzero(bad)]
+            # the temporary name keeps the extension, which selects the compression
+            tmp = os.path.join(qdir, f'.{os.getpid()}.{name}')
+            rows.to_csv(tmp, index=False)
+            os.replace(tmp, os.path.join(qdir, name))
+        # the files are per snapshot and replaced atomically, so processes
+        # loading other snapshots do not get in the way
+        tmp = f'{counts_file}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(counts, f, indent=1, sort_keys=True)
+        os.replace(tmp, counts_file)
+    except OSError as e:
+        # the rows are already treated as unknown, so this is not worth failing for
+        print(f'Warning: could not quarantine the invalid rows of {fname}: {e}')
+
+def load(fname, quarantine_rows=False):
+    # Return the line list as a compact DataFrame: County, Gender and Jurisdiction
+    # are categorical, Age is an int8 (unknown_age if unknown), EventDate and
+    # ChartDate are int16 days since epoch, and Died is a boolean. With
+    # quarantine_rows, the rows with invalid values are also quarantined.
+    f = open_snapshot(fname)
+    try:
+        df = pd.read_csv(f, usecols=columns, dtype={
+            'County': 'category', 'Gender': 'category', 'Jurisdiction': 'category', 'Died': 'category',
+            'EventDate': 'category', 'ChartDate': 'category', 'Age': 'category',
+            })
+    finally:
+        if f is not fname:
+            f.close()
+    age = parse_ages(df['Age'])
+    dates = {col: parse_dates(df[col]) for col in ('EventDate', 'ChartDate')}
+    try:
+        download_day = to_days(snapshot_date(fname))
+    except ValueError:
+        # downloaded from csv_url
+        download_day = to_days(datetime.date.today())
+    rules = validate(df, age, dates, download_day)
+    if quarantine_rows:
+        quarantine(fname, df, rules)
+    unknown = {'Age': np.isnan(age)}
+    for ((col, rule), mask) in rules.items():
+        unknown[col] = unknown.get(col, False) | mask
+    for (col, days) in dates.items():
+        if col in unknown:
+            dates[col] = np.where(unknown[col], unknown_date, days).astype(np.int16)
+    return pd.DataFrame({
+        'County': df['County'],
+        'Age': np.where(unknown['Age'], unknown_age, age).astype(np.int8),
+        'Gender': df['Gender'],
+        'Jurisdiction': df['Jurisdiction'],
+        'Died': (df['Died'] == 'Yes').to_numpy(),
+        'EventDate': dates['EventDate'],
+        'ChartDate': dates['ChartDate'],
+        })
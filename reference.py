@@ -0,0 +1,304 @@
+# Reference implementations used by check.py: the analyses of gamma.py,
+# age_stratified_cfr.py, heatmap.py and forecast_deaths.py as they were written
+# before they were optimized, parsing the CSV with a plain pd.read_csv() and
+# processing it row by row. They are slow, but they are what the optimized
+# scripts must keep reproducing. Only the chart and printing code was removed.
+# The configuration (age brackets, averaging periods, CFR models...) is taken
+# from the scripts, so that both sides always use the same.
+
+import os, math, datetime
+import numpy as np
+import pandas as pd
+import scipy.stats as stats
+import age_stratified_cfr, forecast_deaths, heatmap, gamma
+
+def parse_date(s, fmt='%Y-%m-%d'):
+    return datetime.datetime.strptime(s, fmt).date()
+
+#
+# gamma.py
+#
+
+def normalize_date(s):
+    for fmt in ('%Y-%m-%d', '%Y/%m/%d', '%m/%d/%Y'):
+        try:
+            return str(parse_date(s, fmt=fmt))
+        except ValueError:
+            pass
+    raise Exception(f'Could not parse date "{s}"')
+
+def gamma_parse(fname):
+    # Bucketize deaths by the characteristics of their patients (age, gender, county...)
+    counters = {}
+    df = pd.read_csv(fname)
+    for _, row in df.iterrows():
+        if row['Died'] != 'Yes':
+            continue
+        # We truncate after the whitespace to ignore the time, and normalize the date to YYYY-MM-DD
+        chartdate = normalize_date(row['ChartDate'].split(' ')[0]) # Date the case was counted
+        eventdate = normalize_date(row['EventDate'].split(' ')[0]) # Date of onset
+        characteristics = (
+                # Age MUST be first becuase gamma_o2d() accesses it at a fixed index
+                row['Age'],
+                row['County'],
+                row['Gender'],
+                row['Jurisdiction'],
+                chartdate,
+                eventdate,
+                # EventDate MUST be last because calc_o2d() accesses it at a fixed index
+                )
+        if characteristics not in counters:
+            counters[characteristics] = 0
+        counters[characteristics] += 1
+    return counters
+
+def calc_o2d(fname, characteristics):
+    # Filename must start with "YYYY-MM-DD" which represents the date the
+    # FDOH line list was downloaded, and contains data for the day prior
+    death_reported = parse_date(os.path.basename(fname)[:10]) - datetime.timedelta(days=1)
+    # Parse EventDate (last element of the characteristics tuple)
+    onset = parse_date(characteristics[-1])
+    # Calculate onset-to-death
+    o2d = (death_reported - onset).days
+    assert o2d >= 0
+    return o2d
+
+def gamma_o2d(fnames):
+    # Return the (onset-to-death, age) of the deaths that appeared in each snapshot
+    counters = [gamma_parse(fname) for fname in fnames]
+    o2d_all = []
+    for (i, _) in enumerate(counters):
+        if i == 0:
+            continue
+        for characteristics in counters[i].keys():
+            age = characteristics[0]
+            # Count the number of new deaths reported on this day
+            new_deaths = counters[i][characteristics] - \
+                     counters[i - 1].get(characteristics, 0)
+            o = calc_o2d(fnames[i], characteristics)
+            o2d_all.extend([(o, age)] * new_deaths)
+    return o2d_all
+
+def gamma_fit(o2d_all):
+    # Return the number of deaths, and mean and shape of the fitted Gamma
+    # distribution, by age bracket
+    # Ignore onset-to-death times of 0 days, because these are likely cases where
+    # the date of onset was not known and filled out with the date of death
+    o2d_all = list(filter(lambda x: x[0] > 0, o2d_all))
+    result = {}
+    for bracket in gamma.age_brackets:
+        # get the onset-to-death times only for the specific age bracket
+        o2d = [x[0] for x in list(filter(lambda x: x[1] >= bracket[0] and x[1] <= bracket[1], o2d_all))]
+        result[bracket] = {'deaths': len(o2d)}
+        if len(o2d):
+            # Fit in a Gamma distribution. Note that we fix the location to 0.
+            shape, loc, scale = stats.gamma.fit(o2d, floc=0)
+            result[bracket].update(mean=shape * scale, shape=shape)
+    return result
+
+#
+# age_stratified_cfr.py
+#
+
+class Counters():
+    deaths = 0
+    deaths_adjusted = 0
+    cases = 0
+    cfr_raw = None
+    cfr_adjusted_short = None
+    cfr_adjusted_long = None
+
+def age_to_bracket(age):
+    for (low, high) in age_stratified_cfr.age_brackets:
+        if age >= low and age <= high:
+            return (low, high)
+    raise Exception(f'Could not find bracket for age {age}')
+
+def calc_cfr(data, mean, shape):
+    age_brackets = age_stratified_cfr.age_brackets
+    avg_days = age_stratified_cfr.avg_days
+    avg_days_long = age_stratified_cfr.avg_days_long
+    OVERALL = age_stratified_cfr.OVERALL
+    censoring_rv = stats.gamma(shape, scale=mean / shape)
+    def censoring_factor(days_since_onset):
+        if days_since_onset == 0:
+            days_since_onset = 1
+        return 1 / censoring_rv.cdf(days_since_onset)
+    all_dates = sorted(data.keys())
+    last_date = all_dates[-1]
+    for date in all_dates:
+        for bracket in age_brackets:
+            days_since_onset = (last_date - date).days
+            data[date][bracket].deaths_adjusted = \
+                    data[date][bracket].deaths * censoring_factor(days_since_onset)
+            list_cfr_raw = []
+            list_cfr_adj_short = []
+            list_cfr_adj_long = []
+            for delta in range(avg_days + avg_days_long):
+                date2 = date - datetime.timedelta(delta)
+                if date2 in data:
+                    p = data[date2][bracket]
+                    if p.cases:
+                        if delta < avg_days:
+                            # Accumulate CFR data over the last avg_days days
+                            list_cfr_raw.append(p.deaths / p.cases)
+                            list_cfr_adj_short.append(p.deaths_adjusted / p.cases)
+                        else:
+                            # Accumulate CFR data over the avg_days_long days that
+                            # are immediately trailing the last avg_days days
+                            list_cfr_adj_long.append(p.deaths_adjusted / p.cases)
+            # The average CFR is calculated by assigning equal *weight* to each day's CFR value
+            if list_cfr_raw:
+                data[date][bracket].cfr_raw = 100 * np.mean(list_cfr_raw)
+            if list_cfr_adj_short:
+                data[date][bracket].cfr_adjusted_short = 100 * np.mean(list_cfr_adj_short)
+            if list_cfr_adj_long:
+                data[date][bracket].cfr_adjusted_long = 100 * np.mean(list_cfr_adj_long)
+        # Calculate overall CFR
+        data[date][OVERALL] = Counters()
+        for bracket in age_brackets:
+            data[date][OVERALL].deaths_adjusted += data[date][bracket].deaths_adjusted
+            data[date][OVERALL].cases += data[date][bracket].cases
+        list_cfr = []
+        for delta in range(avg_days_long):
+            date2 = date - datetime.timedelta(days=delta + avg_days)
+            if date2 in data:
+                p = data[date2][OVERALL]
+                if p.cases:
+                    list_cfr.append(p.deaths_adjusted / p.cases)
+        if list_cfr:
+            data[date][OVERALL].cfr_adjusted_long = 100 * np.mean(list_cfr)
+
+def cfr(fname):
+    # Return the Counters by date of onset and age bracket
+    df = pd.read_csv(fname)
+    # Date of onset is EventDate
+    df['date_parsed'] = pd.to_datetime(
+            # Timestamps are formatted as "2020/06/28 05:00:00+00". We truncate
+            # after the whitespace to ignore the time.
+            df['EventDate'].apply(lambda x: x.split(' ')[0]), format='%Y/%m/%d'
+    )
+    data = {}
+    for _, row in df.iterrows():
+        age = row['Age']
+        # on 2020-08-07 a case was added with Age=-1.0
+        if math.isnan(age) or age < 0:
+            continue
+        date = row['date_parsed'].date()
+        died = row['Died'] == 'Yes'
+        if date not in data:
+            data[date] = {bracket: Counters() for bracket in age_stratified_cfr.age_brackets}
+        b = age_to_bracket(age)
+        data[date][b].deaths += 1 if died else 0
+        data[date][b].cases += 1
+    calc_cfr(data, age_stratified_cfr.o2d_mean, age_stratified_cfr.o2d_shape)
+    return data
+
+#
+# heatmap.py
+#
+
+def heatmap_analyze(fname):
+    # Return cases_per_bracket, ages, share_positive and cases_per_capita
+    buckets_days = heatmap.buckets_days
+    buckets_ages = heatmap.buckets_ages
+    df = pd.read_csv(fname)
+    # We show cases by date reported (ChartDate)
+    # We truncate after the whitespace to ignore the time and try to parse YYYY/MM/DD or MM/DD/YYYY
+    try:
+        df["date_parsed"] = pd.to_datetime(
+                df["ChartDate"].apply(lambda x: x.split(' ')[0]), format="%Y/%m/%d"
+        )
+    except ValueError:
+        df["date_parsed"] = pd.to_datetime(
+                df["ChartDate"].apply(lambda x: x.split(' ')[0]), format="%m/%d/%Y"
+        )
+    # Pick a reference point in time to align the time periods. The date one day past the
+    # last date in the dataset is the best choice because it aligns the last period so it
+    # ends on, and includes, the last date in the dataset.
+    reference = sorted(set(df['date_parsed']))[-1].date() + datetime.timedelta(days=1)
+    df["Delta"] = df["date_parsed"].apply(lambda date: (date.date() - reference).days)
+    df["Period"] = df["Delta"].apply(
+        lambda delta: reference + datetime.timedelta(days=delta - delta % buckets_days)
+    )
+    cases_per_bracket = {}
+    ages = {}
+    non_null = df[~df["Age"].isnull()]
+    periods = set(df["Period"])
+    for period in periods:
+        cases_per_bracket[period] = {bucket: 0 for bucket in buckets_ages}
+        ages[period] = []
+        in_period = non_null["Period"] == period
+        for bucket in buckets_ages:
+            (low_age, high_age) = bucket
+            in_age_bucket = (low_age <= non_null["Age"]) & (non_null["Age"] <= high_age)
+            in_period_and_age = in_period & in_age_bucket
+            cases_per_bracket[period][bucket] = in_period_and_age.sum()
+            ages[period].extend(list(non_null[in_period_and_age]["Age"]))
+    # calculate share_positive
+    share_positive = {}
+    for (period, cases_data) in cases_per_bracket.items():
+        total_cases = sum(cases_data.values())
+        share_positive[period] = {}
+        for (bucket, cases) in cases_data.items():
+            share_positive[period][bucket] = 100 * cases / total_cases
+    for period in periods:
+        if period < datetime.date(2020, 3, 13):
+            del share_positive[period]
+    # calculate cases_per_capita
+    cases_per_capita = {}
+    for (period, cases_data) in cases_per_bracket.items():
+        cases_per_capita[period] = {}
+        for (bucket, cases) in cases_data.items():
+            cases_per_capita[period][bucket] = heatmap.per_1000(bucket, cases)
+    return cases_per_bracket, ages, share_positive, cases_per_capita
+
+#
+# forecast_deaths.py
+#
+
+def cfr_for_age(model, age):
+    # Given a patient age, return the Case Fatality Ratio for their age
+    if math.isnan(age) or age < 0:
+        # For patients whose age is unknown (less than 1% of all cases),
+        # assume the average CFR
+        return model.cfr_average
+    for (bracket, cfr) in model.cfr_by_age.items():
+        if age in range(bracket[0], bracket[1] + 1):
+            return cfr
+    raise Exception(f'Could not find IFR for age {age} in model {model.source}')
+
+def sma(arr, avg_days=forecast_deaths.avg_days):
+    arr2 = []
+    i = avg_days - 1
+    while i < len(arr):
+        vals = [x[1] for x in arr[i - avg_days + 1:i + 1]]
+        arr2.append((arr[i][0], np.mean(vals)))
+        i += 1
+    return arr2
+
+def forecast(fname):
+    # Return the deaths forecast by each model, as lists of (date, deaths)
+    df = pd.read_csv(fname)
+    # We estimate deaths based on the mean onset-to-death time, so we must work from EventDate.
+    df['date_parsed'] = pd.to_datetime(
+            df['EventDate'].apply(lambda x: x.split(' ')[0]), format='%Y/%m/%d'
+    )
+    last_day = sorted(set(df['date_parsed']))[-1].date()
+    first_day = sorted(set(df['date_parsed']))[0].date()
+    models = forecast_deaths.cfr_models
+    deaths = [[] for i in range(len(models))]
+    day = first_day
+    while day <= last_day:
+        ages = list(df[df['date_parsed'] == pd.Timestamp(day)]['Age'])
+        future_day = day + datetime.timedelta(days=np.round(forecast_deaths.o2d))
+        for (i, model) in enumerate(models):
+            f = sum([cfr_for_age(model, a) for a in ages])
+            if day == last_day:
+                # line list data is almost always incomplete for the last day
+                f = max(f, deaths[i][-1][1])
+            deaths[i].append((future_day, f))
+        day += datetime.timedelta(days=1)
+    for i in range(len(deaths)):
+        deaths[i] = sma(deaths[i])
+    return deaths
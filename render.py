@@ -0,0 +1,105 @@
+# Renders charts in a process pool, skipping charts whose inputs did not change
+# since they were last rendered.
+
+import os, sys, json, hashlib, inspect, pickle, datetime, threading
+import concurrent.futures
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+
+# Maps the filename of every rendered chart to the hash of its inputs
+cache_file = '.render_cache.json'
+# Serializes the updates of cache_file by the threads of this process
+cache_lock = threading.Lock()
+# Source of the modules defining chart functions, by module name
+sources = {}
+
+def source(module):
+    if module.__name__ not in sources:
+        sources[module.__name__] = inspect.getsource(module)
+    return sources[module.__name__]
+
+# Each instance represents one chart: calling func(*args, **kwargs) writes it to filename
+class Chart():
+    def __init__(self, filename, func, *args, **kwargs):
+        self.filename = filename
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+
+    def digest(self):
+        # The source of the module defining the chart function (which includes
+        # the helpers and settings it uses) and of this module are hashed along
+        # with its inputs, so that editing them also invalidates the chart
+        h = hashlib.sha256()
+        h.update(source(inspect.getmodule(self.func)).encode())
+        h.update(source(sys.modules[__name__]).encode())
+        h.update(pickle.dumps(canonical((self.args, self.kwargs)), protocol=4))
+        return h.hexdigest()
+
+def canonical(obj):
+    # Convert obj to a structure whose pickle does not depend on the iteration
+    # order of dicts and sets (which may depend on the hash seed of the process)
+    if isinstance(obj, dict):
+        return ('dict', sorted((repr(k), canonical(v)) for (k, v) in obj.items()))
+    if isinstance(obj, (set, frozenset)):
+        return ('set', sorted(repr(canonical(x)) for x in obj))
+    if isinstance(obj, (list, tuple)):
+        return (type(obj).__name__, [canonical(x) for x in obj])
+    if isinstance(obj, np.ndarray):
+        return ('ndarray', str(obj.dtype), obj.shape, obj.tobytes())
+    if isinstance(obj, (np.generic, datetime.date)):
+        return repr(obj)
+    if hasattr(obj, '__dict__') and not callable(obj):
+        return (type(obj).__name__, canonical(vars(obj)))
+    return obj
+
+def load_cache():
+    try:
+        return json.load(open(cache_file))
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def save_cache(digests):
+    # Re-read the cache before updating it, because another script may have
+    # rendered other charts in the meantime
+    with cache_lock:
+        cache = load_cache()
+        cache.update(digests)
+        tmp = f'{cache_file}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(cache, f, indent=1, sort_keys=True)
+        os.replace(tmp, cache_file)
+
+def init_worker():
+    matplotlib.use('Agg')
+
+def render_one(chart):
+    chart.func(*chart.args, **chart.kwargs)
+    plt.close('all')
+    return chart.filename
+
+def render(charts, processes=None):
+    cache = load_cache()
+    digests = {c.filename: c.digest() for c in charts}
+    stale = []
+    for c in charts:
+        if os.path.exists(c.filename) and cache.get(c.filename) == digests[c.filename]:
+            print(f'Chart {c.filename} is up to date')
+        else:
+            stale.append(c)
+    # pyplot is not thread-safe, so charts are rendered in this process only
+    # when render() is not called from a thread
+    in_main_thread = threading.current_thread() is threading.main_thread()
+    if in_main_thread and (len(stale) == 1 or processes == 1):
+        # not worth starting a process pool
+        for c in stale:
+            render_one(c)
+    elif stale:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=processes, initializer=init_worker) as executor:
+            # list() propagates exceptions raised in the workers
+            list(executor.map(render_one, stale))
+    for c in stale:
+        print(f'Rendered {c.filename}')
+    save_cache({c.filename: digests[c.filename] for c in stale})
@@ -0,0 +1,109 @@
+#!/usr/bin/python3
+#
+# Archives "Deaths by Day" snapshots and incrementally estimates the delay with
+# which FDOH reports deaths by date of death.
+
+import sys, os, math, datetime, json
+import numpy as np
+import chain_ladder
+
+# Observed deaths, by date death occurred (fetched by data_deaths/deaths_by_date_of_death)
+csv_deaths_occurred = 'data_deaths/deaths_by_date_of_death.csv'
+# Every fetch of csv_deaths_occurred is archived in this directory as a compact
+# array named after the date of the fetch (YYYY-MM-DD.npy)
+archive_dir = 'data_deaths/archive'
+# State of the incremental estimator
+state_file = 'data_deaths/reporting_delay.npz'
+# Element 0 of the archived arrays is the number of deaths on this date
+epoch = datetime.date(2020, 1, 1)
+# Deaths are assumed to be fully reported this many days after they occurred
+max_lag = 90
+# The estimated growth of a lag is only trusted once this many pairs of
+# consecutive snapshots, with at least this many deaths at that lag in total,
+# were compared. The fallback is used for the other lags.
+min_pairs = 7
+min_deaths = 100
+# Fallback used until enough snapshots have been archived: the CDF of death
+# reporting (1 - e^(-lamda*x)) gives the approximate fraction of total deaths
+# that are reported x days after the death, see:
+# https://github.com/mbevand/florida-covid19-deaths-by-day/blob/master/README.md#average-reporting-delay
+default_lamda = 0.1428
+
+parse_date = chain_ladder.parse_date
+
+def parse(fname):
+    # Parse a "Deaths by Day" JSON dump, return a sorted list of (date, deaths)
+    result = []
+    for feature in json.load(open(fname))['features']:
+        attrs = feature['attributes']
+        date = datetime.datetime.utcfromtimestamp(attrs['Date'] / 1e3).date()
+        deaths = attrs['Deaths']
+        # occasionally we see bogus rows with dates from years ago. ignore them
+        if date >= epoch:
+            result.append((date, deaths))
+    # result is usually already sorted in the JSON dump, but sort it to guarantee it
+    return sorted(result)
+
+def to_array(deaths_by_day):
+    # Convert a list of (date, deaths) to an array indexed by days since epoch
+    arr = np.zeros((deaths_by_day[-1][0] - epoch).days + 1, dtype=np.int32)
+    for date, deaths in deaths_by_day:
+        arr[(date - epoch).days] = deaths
+    return arr
+
+def archive(fname, date_of_fetch):
+    os.makedirs(archive_dir, exist_ok=True)
+    path = f'{archive_dir}/{date_of_fetch}.npy'
+    arr = to_array(parse(fname))
+    np.save(path, arr)
+    print(f'Archived {fname} to {path}')
+    return arr
+
+def new_state():
+    return chain_ladder.new_state(max_lag)
+
+def load_state():
+    return chain_ladder.load_state(state_file, max_lag)
+
+def save_state(state):
+    chain_ladder.save_state(state, state_file)
+
+def update(state, date, arr):
+    # Update the estimator with the snapshot arr fetched on date. Deaths that
+    # occurred on the day of the fetch have lag 0.
+    chain_ladder.update(state, date, arr, (date - epoch).days)
+
+def completeness(state=None):
+    # Return an array whose element x is the fraction of deaths reported x days
+    # after they occurred, x = 0 .. max_lag
+    if state is None:
+        state = load_state()
+    x = np.arange(max_lag + 1)
+    fallback = 1 - math.e**(-default_lamda * x)
+    return chain_ladder.completeness(state, fallback, min_pairs, min_deaths)
+
+def print_stats(frac):
+    for x in (1, 2, 3, 5, 7, 10, 14, 21, 28):
+        print(f'{100 * frac[x]:5.1f}% of deaths reported after {x} days')
+
+def rebuild():
+    state = new_state()
+    for f in sorted(os.listdir(archive_dir)):
+        if f.endswith('.npy'):
+            update(state, parse_date(f[:10]), np.load(f'{archive_dir}/{f}'))
+    return state
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == '-rebuild':
+        # refit from scratch over all archived snapshots
+        state = rebuild()
+    else:
+        fname = sys.argv[1] if len(sys.argv) > 1 else csv_deaths_occurred
+        date_of_fetch = parse_date(sys.argv[2]) if len(sys.argv) > 2 else datetime.date.today()
+        state = load_state()
+        update(state, date_of_fetch, archive(fname, date_of_fetch))
+    save_state(state)
+    print_stats(completeness(state))
+
+if __name__ == '__main__':
+    main()
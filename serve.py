@@ -0,0 +1,248 @@
+#!/usr/bin/python3
+#
+# Serves the series computed on the latest line list snapshot as JSON over HTTP,
+# and reloads them when a new snapshot is downloaded to data_fdoh.
+#
+#   $ ./serve.py [port]
+#   $ curl http://127.0.0.1:8020/cfr
+
+import sys, os, math, json, datetime, asyncio
+import concurrent.futures, multiprocessing
+import numpy as np
+import linelist
+import case_backfill
+import age_stratified_cfr, forecast_deaths, heatmap, gamma
+
+host = '127.0.0.1'
+port = 8020
+# Seconds between checks for a new snapshot. data_fdoh/download renames a
+# snapshot into place once it is complete, so a listed snapshot can be loaded.
+poll_interval = 10
+endpoints = ('/cfr', '/forecast', '/heatmap', '/gamma')
+
+def key2str(k):
+    if isinstance(k, tuple):
+        # age bracket
+        return f'{k[0]}+' if k[1] == math.inf else f'{k[0]}-{k[1]}'
+    if isinstance(k, datetime.date):
+        return k.isoformat()
+    return str(k)
+
+def jsonable(obj):
+    if isinstance(obj, dict):
+        return {key2str(k): jsonable(v) for (k, v) in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [jsonable(x) for x in obj]
+    if isinstance(obj, datetime.date):
+        return obj.isoformat()
+    if isinstance(obj, np.generic):
+        obj = obj.item()
+    if isinstance(obj, float) and not math.isfinite(obj):
+        return None
+    if isinstance(obj, age_stratified_cfr.Counters):
+        return jsonable({k: getattr(obj, k) for k in
+            ('cases', 'deaths', 'deaths_adjusted', 'cfr_raw', 'cfr_adjusted_short', 'cfr_adjusted_long')})
+    return obj
+
+def encode(obj):
+    return json.dumps(jsonable(obj), separators=(',', ':')).encode()
+
+def compute_snapshot(fname):
+    # Return the response bodies of the endpoints computed on a single snapshot
+    df = linelist.load(fname)
+    date_of_data = linelist.snapshot_date(fname)
+    # completeness of the cases of the last days of onset, updated by data_fdoh/download
+    backfill = case_backfill.completeness()
+    # calc_cfr output per bracket
+    data = age_stratified_cfr.analyze(df, backfill=backfill, date_of_data=date_of_data)
+    cfr = {}
+    for bracket in list(age_stratified_cfr.age_brackets) + [age_stratified_cfr.OVERALL]:
+        name = 'overall' if bracket == age_stratified_cfr.OVERALL else key2str(bracket)
+        cfr[name] = [dict(date=date, **jsonable(counters[bracket])) for (date, counters) in sorted(data.items())]
+    # forecasts of every CFR model, and best guess band
+    deaths = forecast_deaths.forecast(df, backfill=backfill, date_of_data=date_of_data)
+    deaths_best_guess = forecast_deaths.best_guess(date_of_data, deaths, forecast_deaths.reported())
+    forecast = {
+            'models': {model.model_no: deaths[i] for (i, model) in enumerate(forecast_deaths.cfr_models)},
+            'best_guess': deaths_best_guess,
+            }
+    # heatmaps
+    cases_per_bracket, ages, share_positive, cases_per_capita = heatmap.analyze(df)
+    hm = {
+            'cases_per_bracket': dict(sorted(cases_per_bracket.items())),
+            'share_positive': dict(sorted(share_positive.items())),
+            'cases_per_capita': dict(sorted(cases_per_capita.items())),
+            'median_age': {period: np.median(a) for (period, a) in sorted(ages.items())},
+            }
+    return {'/cfr': encode(cfr), '/forecast': encode(forecast), '/heatmap': encode(hm)}
+
+# State of the incremental onset-to-death calculation: the last snapshot counted,
+# its counters, and the onset-to-death times of all deaths so far. It lives in
+# the worker process running compute_gamma(), so that it is not pickled between
+# the server and the worker on every new snapshot.
+gamma_state = None
+
+def compute_gamma(fnames, last):
+    # Count the deaths that appeared in fnames (consecutive snapshots following
+    # last, or the first snapshots if last is None) and refit the Gamma
+    # distributions. A snapshot that fails to parse is skipped, so that it is not
+    # parsed again on every poll.
+    global gamma_state
+    if last is None:
+        (prev_counters, o2d_all) = (None, [])
+    elif gamma_state is None or gamma_state[0] != last:
+        raise Exception(f'Onset-to-death state is not at {last}')
+    else:
+        # copied, so that the state is unchanged if a snapshot fails to parse
+        (prev_counters, o2d_all) = (gamma_state[1], list(gamma_state[2]))
+    for fname in fnames:
+        try:
+            df = gamma.parse(fname)
+        except Exception as e:
+            print(f'Could not parse {fname}: {e!r}')
+            # the deaths of the next snapshot can not be attributed to a single day
+            prev_counters = None
+            continue
+        prev_counters = gamma.accumulate(fname, df, prev_counters, o2d_all)
+    params = {}
+    for (bracket, (o2d, shape, loc, scale)) in gamma.fit(o2d_all).items():
+        params[bracket] = {'deaths': len(o2d)}
+        if len(o2d):
+            params[bracket].update(mean=shape * scale, shape=shape, median=np.median(o2d))
+    gamma_state = (fnames[-1], prev_counters, o2d_all)
+    return encode(params)
+
+def new_executor():
+    # Workers are not forked from the server, so they do not inherit its socket.
+    # A single worker, so that compute_gamma() always finds its state.
+    return concurrent.futures.ProcessPoolExecutor(max_workers=1,
+            mp_context=multiprocessing.get_context('forkserver'))
+
+class Service():
+    def __init__(self, datadir=linelist.datadir):
+        self.datadir = datadir
+        # Response bodies by path. Replaced as a whole (never modified in place)
+        # so that a request never sees a mix of two snapshots
+        self.responses = {}
+        self.snapshot = None
+        # Snapshots that failed to load, never retried: the latest of the others is served
+        self.failed = set()
+        # Last snapshot counted by the incremental onset-to-death calculation,
+        # whose state is in the worker of gamma_executor
+        self.gamma_last = None
+        self.executor = new_executor()
+        self.gamma_executor = new_executor()
+        self.publish({})
+
+    def publish(self, updates):
+        responses = dict(self.responses)
+        responses.update(updates)
+        responses['/'] = encode({
+            'snapshot': self.snapshot and os.path.basename(self.snapshot),
+            'gamma_snapshot': self.gamma_last and os.path.basename(self.gamma_last),
+            'endpoints': [e for e in endpoints if e in responses],
+            })
+        self.responses = responses
+
+    async def reload_snapshot(self, fname):
+        print(f'Loading {fname}')
+        loop = asyncio.get_running_loop()
+        try:
+            updates = await loop.run_in_executor(self.executor, compute_snapshot, fname)
+        except Exception as e:
+            if isinstance(e, concurrent.futures.process.BrokenProcessPool):
+                self.executor = new_executor()
+            self.failed.add(fname)
+            raise
+        self.snapshot = fname
+        self.publish(updates)
+        print(f'Serving series of {fname}')
+
+    async def reload_gamma(self, fnames):
+        loop = asyncio.get_running_loop()
+        try:
+            body = await loop.run_in_executor(self.gamma_executor, compute_gamma, fnames, self.gamma_last)
+        except concurrent.futures.process.BrokenProcessPool:
+            # the state died with the worker, start over from the first snapshot
+            self.gamma_executor = new_executor()
+            self.gamma_last = None
+            raise
+        self.gamma_last = fnames[-1]
+        self.publish({'/gamma': body})
+        print(f'Serving onset-to-death distribution up to {fnames[-1]}')
+
+    async def watch(self):
+        while True:
+            files = linelist.snapshots(self.datadir)
+            tasks = []
+            good = [f for f in files if f not in self.failed]
+            if good and (self.snapshot is None or good[-1] > self.snapshot):
+                tasks.append(self.reload_snapshot(good[-1]))
+            new = [f for f in files if self.gamma_last is None or f > self.gamma_last]
+            if new and len(files) >= 2:
+                tasks.append(self.reload_gamma(new))
+            # a bad snapshot must not bring the service down, keep serving the previous one
+            for result in await asyncio.gather(*tasks, return_exceptions=True):
+                if isinstance(result, Exception):
+                    print(f'Reload failed: {result!r}')
+            await asyncio.sleep(poll_interval)
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request = await reader.readline()
+                if not request:
+                    break
+                try:
+                    (method, path, version) = request.decode('latin-1').split()
+                except ValueError:
+                    await self.respond(writer, 400, encode({'error': 'bad request'}), False)
+                    break
+                keep_alive = version == 'HTTP/1.1'
+                while True:
+                    header = (await reader.readline()).decode('latin-1').strip().lower()
+                    if not header:
+                        break
+                    if header.startswith('connection:'):
+                        keep_alive = 'keep-alive' in header
+                path = path.split('?')[0]
+                responses = self.responses
+                if method != 'GET':
+                    await self.respond(writer, 405, encode({'error': 'method not allowed'}), keep_alive)
+                elif path in responses:
+                    await self.respond(writer, 200, responses[path], keep_alive)
+                elif path in endpoints:
+                    await self.respond(writer, 503, encode({'error': 'not loaded yet'}), keep_alive)
+                else:
+                    await self.respond(writer, 404, encode({'error': 'not found'}), keep_alive)
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, writer, status, body, keep_alive):
+        reason = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+                503: 'Service Unavailable'}[status]
+        header = (
+                f'HTTP/1.1 {status} {reason}\r\n'
+                'Content-Type: application/json\r\n'
+                f'Content-Length: {len(body)}\r\n'
+                f'Connection: {"keep-alive" if keep_alive else "close"}\r\n'
+                '\r\n')
+        writer.write(header.encode() + body)
+        await writer.drain()
+
+async def serve(service, host, port):
+    server = await asyncio.start_server(service.handle, host, port)
+    print(f'Serving on http://{host}:{port}')
+    async with server:
+        await asyncio.gather(server.serve_forever(), service.watch())
+
+def main():
+    p = int(sys.argv[1]) if len(sys.argv) > 1 else port
+    asyncio.run(serve(Service(), host, p))
+
+if __name__ == '__main__':
+    main()
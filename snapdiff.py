@@ -0,0 +1,68 @@
+# Identifies rows of line list snapshots by a 64-bit hash of their
+# characteristics, and diffs snapshots to find the rows added or removed.
+#
+# Rows have no unique identifier, so two rows with the same characteristics are
+# indistinguishable: a snapshot is reduced to sorted arrays of unique keys, the
+# number of rows having each key, and the payload columns of these rows.
+
+import numpy as np
+import pandas as pd
+
+# Characteristics identifying a row. Most rows are unique, see gamma.count()
+columns = ['Age', 'County', 'Gender', 'Jurisdiction', 'ChartDate', 'EventDate']
+# Columns whose value is kept for every key
+payload = ['Age', 'EventDate']
+
+def keys(df):
+    # Categoricals are hashed by value, not by code, so the same row hashes the
+    # same in snapshots having different categories
+    return pd.util.hash_pandas_object(df[columns], index=False).to_numpy()
+
+def index(df):
+    # Return the index of the rows of df: 'keys' sorted, 'counts' the number of
+    # rows with each key, and the payload columns
+    (k, first, counts) = np.unique(keys(df), return_index=True, return_counts=True)
+    idx = {'keys': k, 'counts': counts.astype(np.int32)}
+    for col in payload:
+        idx[col] = df[col].to_numpy()[first]
+    return idx
+
+def lookup(idx, k):
+    # Return the positions of the sorted keys k in idx, and whether they were found
+    pos = np.searchsorted(idx['keys'], k)
+    found = pos < len(idx['keys'])
+    found[found] = idx['keys'][pos[found]] == k[found]
+    return pos, found
+
+def counts_of(idx, k):
+    pos, found = lookup(idx, k)
+    counts = np.zeros(len(k), dtype=np.int32)
+    counts[found] = idx['counts'][pos[found]]
+    return counts
+
+def subset(idx, mask, counts):
+    result = {'keys': idx['keys'][mask], 'counts': counts[mask]}
+    for col in payload:
+        result[col] = idx[col][mask]
+    return result
+
+def diff(old, new):
+    # Return the indexes of the rows added to and removed from old to get new.
+    # Their counts are the multiplicities: a key present 3 times in old and 5
+    # times in new was added 2 times.
+    k = np.union1d(old['keys'], new['keys'])
+    delta = counts_of(new, k) - counts_of(old, k)
+    # payload of the union, from new where the key is in new, else from old
+    union = {'keys': k}
+    pos_new, in_new = lookup(new, k)
+    pos_old, _ = lookup(old, k)
+    for col in payload:
+        values = np.empty(len(k), dtype=np.result_type(new[col], old[col]))
+        values[in_new] = new[col][pos_new[in_new]]
+        values[~in_new] = old[col][pos_old[~in_new]]
+        union[col] = values
+    return subset(union, delta > 0, delta), subset(union, delta < 0, -delta)
+
+def rows(idx):
+    # Expand an index to one value per row, for each payload column
+    return {col: np.repeat(idx[col], idx['counts']) for col in payload}
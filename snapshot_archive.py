@@ -0,0 +1,188 @@
+#!/usr/bin/python3
+#
+# Stores the typed columns of every line list snapshot in a single file that is
+# memory-mapped, so that any snapshot can be read without decompressing and
+# parsing its CSV.
+#
+#   $ ./snapshot_archive.py [data_fdoh/2020-09-01-08-00-00.csv.gz ...]
+#
+# Adds the given snapshots (by default all of those in data_fdoh) to the archive.
+#
+# The rows of each snapshot are sorted by EventDate, and the index records the
+# first EventDate of every block of block_rows rows, so that the rows of a range
+# of dates of onset can be read without reading the whole snapshot.
+
+import sys, os, json
+import numpy as np
+import pandas as pd
+import linelist
+
+# Rows of all snapshots, one after the other, as records of the dtype below
+archive_file = 'data_fdoh/archive.bin'
+# Offset, number of rows and block index of each snapshot in archive_file, and
+# categories of the categorical columns (shared by all snapshots)
+index_file = 'data_fdoh/archive.json'
+block_rows = 4096
+categorical = ['County', 'Gender', 'Jurisdiction']
+# Categorical columns are stored as codes into the categories, -1 if missing
+record = np.dtype([
+    ('County', np.int16),
+    ('Age', np.int8),
+    ('Gender', np.int16),
+    ('Jurisdiction', np.int16),
+    ('Died', np.bool_),
+    ('EventDate', np.int16),
+    ('ChartDate', np.int16),
+    ])
+
+def load_index():
+    try:
+        return json.load(open(index_file))
+    except FileNotFoundError:
+        return {'snapshots': {}, 'rows': 0, 'categories': {c: [] for c in categorical}}
+
+def save_index(index):
+    tmp = index_file + '.tmp'
+    json.dump(index, open(tmp, 'w'), indent=1, sort_keys=True)
+    os.replace(tmp, index_file)
+
+def to_records(df, categories):
+    # Convert a frame returned by linelist.load() to records, adding its new
+    # categories to categories
+    rec = np.empty(len(df), dtype=record)
+    for col in record.names:
+        if col in categorical:
+            known = categories[col]
+            new = set(df[col].cat.categories) - set(known)
+            known.extend(sorted(new))
+            code_of = {c: i for (i, c) in enumerate(known)}
+            codes = np.array([code_of[c] for c in df[col].cat.categories] + [-1], dtype=np.int16)
+            # missing values have the code -1, which picks the last element
+            rec[col] = codes[df[col].cat.codes.to_numpy()]
+        else:
+            rec[col] = df[col].to_numpy()
+    return rec
+
+def add(fname, index):
+    name = os.path.basename(fname)
+    if name in index['snapshots']:
+        print(f'{fname} already archived')
+        return
+    print(f'Archiving {fname}')
+    rec = to_records(linelist.load(fname, quarantine_rows=True), index['categories'])
+    # unknown dates (linelist.unknown_date) sort first
+    rec = rec[np.argsort(rec['EventDate'], kind='stable')]
+    with open(archive_file, 'ab') as f:
+        # drop what was appended by an interrupted run, not referenced by the index
+        f.truncate(index['rows'] * record.itemsize)
+        f.write(rec.tobytes())
+    index['snapshots'][name] = {'start': index['rows'], 'rows': len(rec),
+            'blocks': rec['EventDate'][::block_rows].tolist()}
+    index['rows'] += len(rec)
+
+def names(index=None):
+    # Return the names of the archived snapshots, oldest first
+    if index is None:
+        index = load_index()
+    return sorted(index['snapshots'])
+
+def find(date, index=None):
+    # Return the name of the last snapshot downloaded on date
+    matches = [n for n in names(index) if linelist.snapshot_date(n) == date]
+    if not matches:
+        raise KeyError(f'No archived snapshot for {date}')
+    return matches[-1]
+
+def rows_between(s, first, last):
+    # Return the range of rows of the snapshot s that may have an EventDate
+    # between first and last (in days since linelist.epoch), from its block index
+    if 'blocks' not in s:
+        # archived before the rows were sorted
+        return 0, s['rows']
+    blocks = s['blocks']
+    # the rows of first may start in the block before the first block starting after first
+    start = max(np.searchsorted(blocks, first, side='left') - 1, 0) * block_rows
+    end = min(np.searchsorted(blocks, last, side='right') * block_rows, s['rows'])
+    return start, end
+
+def records(name, index=None, first=None, last=None):
+    # Return the records of the snapshot name (or downloaded on a date) as a
+    # read-only view of the memory-mapped archive_file. If first or last (dates)
+    # are given, return only the records whose EventDate is between them.
+    if index is None:
+        index = load_index()
+    if not isinstance(name, str):
+        name = find(name, index)
+    s = index['snapshots'][os.path.basename(name)]
+    (start, end) = (0, s['rows'])
+    window = first is not None or last is not None
+    if window:
+        first = linelist.to_days(first) if first is not None else linelist.unknown_date + 1
+        last = linelist.to_days(last) if last is not None else np.iinfo(np.int16).max
+        (start, end) = rows_between(s, first, last)
+    if start >= end:
+        return np.empty(0, dtype=record)
+    rec = np.memmap(archive_file, dtype=record, mode='r', offset=(s['start'] + start) * record.itemsize,
+            shape=(end - start,))
+    if not window:
+        return rec
+    days = rec['EventDate']
+    if 'blocks' in s:
+        # sorted: the records between first and last are contiguous
+        return rec[np.searchsorted(days, first, side='left'):np.searchsorted(days, last, side='right')]
+    return rec[(days >= first) & (days <= last)]
+
+def to_frame(rec, index):
+    # Return the records as a frame with the columns and dtypes of linelist.load()
+    columns = {}
+    for col in linelist.columns:
+        if col in categorical:
+            columns[col] = pd.Categorical.from_codes(rec[col], index['categories'][col])
+        else:
+            columns[col] = rec[col]
+    return pd.DataFrame(columns)
+
+def load(fname, index=None, first=None, last=None):
+    # Load a snapshot from the archive if it was archived, otherwise from its CSV.
+    # If first or last (dates) are given, load only the rows whose EventDate is
+    # between them.
+    if index is None:
+        index = load_index()
+    if os.path.basename(fname) not in index['snapshots']:
+        df = linelist.load(fname)
+        if first is None and last is None:
+            return df
+        days = df['EventDate']
+        keep = days != linelist.unknown_date
+        if first is not None:
+            keep &= days >= linelist.to_days(first)
+        if last is not None:
+            keep &= days <= linelist.to_days(last)
+        return df[keep].reset_index(drop=True)
+    return to_frame(records(fname, index, first, last), index)
+
+def last_onset(fname, index=None):
+    # Return the last EventDate of a snapshot
+    if index is None:
+        index = load_index()
+    s = index['snapshots'].get(os.path.basename(fname))
+    if s is None or 'blocks' not in s or not s['rows']:
+        days = load(fname, index)['EventDate']
+        return linelist.to_date(days[days != linelist.unknown_date].max())
+    # the last record has the last date, read only this one
+    return linelist.to_date(records(fname, index)[-1]['EventDate'])
+
+def main():
+    fnames = sys.argv[1:] if len(sys.argv) > 1 else linelist.snapshots()
+    index = load_index()
+    for fname in fnames:
+        # a corrupt snapshot must not prevent archiving the others
+        try:
+            add(fname, index)
+        except Exception as e:
+            print(f'Could not archive {fname}: {e!r}')
+            continue
+        save_index(index)
+
+if __name__ == '__main__':
+    main()
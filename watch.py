@@ -0,0 +1,123 @@
+#!/usr/bin/python3
+#
+# Watches data_fdoh and data_deaths, and refreshes the charts as soon as a new
+# line list or new death data is downloaded. Parsed state is kept in memory
+# between downloads so that only the new line list needs to be parsed.
+#
+# Uses inotify if the inotify_simple module is installed, otherwise polls.
+
+import sys, os, time, traceback
+import linelist
+import snapshot_archive
+import case_backfill
+import render
+import age_stratified_cfr, forecast_deaths, heatmap, gamma
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+# Seconds between checks for changes when inotify is not available
+poll_interval = 10
+# After a change is detected, wait this many seconds for the download scripts to
+# finish (data_fdoh/download renames the complete line list into place, then
+# archives it)
+settle_time = 2
+# Changes to these files only affect the forecast
+deaths_files = (forecast_deaths.csv_deaths_reported, forecast_deaths.csv_deaths_occurred)
+
+def mtimes(fnames):
+    return tuple(os.path.getmtime(f) if os.path.exists(f) else None for f in fnames)
+
+class Watcher():
+    def __init__(self, datadir=linelist.datadir):
+        self.datadir = datadir
+        # last line list seen, last one parsed (self.df), and the one the
+        # products were last computed on
+        self.snapshot = None
+        self.df_of = None
+        self.df = None
+        self.products_of = None
+        # counters of the last line list, and onset-to-death times of all deaths so far
+        self.gamma_counters = None
+        self.o2d_all = []
+        # forecasts of the CFR models on the last line list
+        self.date_of_data = None
+        self.deaths = None
+        self.deaths_mtimes = None
+        self.dirs = [datadir] + sorted(set(os.path.dirname(f) for f in deaths_files))
+        self.inotify = None
+        if inotify_simple is not None:
+            # created once so that changes made while refreshing are not missed
+            self.inotify = inotify_simple.INotify()
+            flags = inotify_simple.flags
+            for d in self.dirs:
+                self.inotify.add_watch(d, flags.CLOSE_WRITE | flags.MOVED_TO | flags.DELETE)
+
+    def refresh(self):
+        charts = []
+        # onset-to-death needs every line list, the other products only need the latest
+        index = snapshot_archive.load_index()
+        for fname in linelist.snapshots(self.datadir):
+            if self.snapshot is not None and fname <= self.snapshot:
+                continue
+            self.snapshot = fname
+            print(f'Parsing {fname}')
+            # a corrupt snapshot must not prevent processing the later ones
+            try:
+                # read from the archive when the snapshot was archived, much
+                # faster than parsing its CSV
+                df = snapshot_archive.load(fname, index)
+            except Exception as e:
+                print(f'Could not parse {fname}: {e!r}')
+                # the deaths of the next snapshot can not be attributed to a single day
+                self.gamma_counters = None
+                continue
+            self.gamma_counters = gamma.accumulate(fname, df, self.gamma_counters, self.o2d_all)
+            self.df_of = fname
+            self.df = df
+        if self.df_of != self.products_of:
+            df = self.df
+            # completeness of the cases of the last days of onset, updated by data_fdoh/download
+            backfill = case_backfill.completeness()
+            self.date_of_data = linelist.snapshot_date(self.df_of)
+            data = age_stratified_cfr.analyze(df, backfill=backfill, date_of_data=self.date_of_data)
+            charts += age_stratified_cfr.charts(data)
+            cases_per_bracket, _, share_positive, cases_per_capita = heatmap.analyze(df)
+            charts += heatmap.charts(cases_per_bracket, share_positive, cases_per_capita)
+            self.deaths = forecast_deaths.forecast(df, backfill=backfill, date_of_data=self.date_of_data)
+            self.deaths_mtimes = None
+            charts += gamma.report(gamma.fit(self.o2d_all))
+            self.products_of = self.df_of
+        deaths_mtimes = mtimes(deaths_files)
+        if self.deaths is not None and deaths_mtimes != self.deaths_mtimes:
+            charts += forecast_deaths.charts(self.date_of_data, self.deaths)
+            self.deaths_mtimes = deaths_mtimes
+        render.render(charts)
+
+    def wait(self):
+        # Block until something changed in the watched directories
+        if self.inotify is None:
+            before = mtimes(self.dirs + list(deaths_files))
+            while mtimes(self.dirs + list(deaths_files)) == before:
+                time.sleep(poll_interval)
+        else:
+            self.inotify.read()
+        time.sleep(settle_time)
+        if self.inotify is not None:
+            # discard the events of the download that happened while we slept
+            self.inotify.read(timeout=0)
+
+def main():
+    watcher = Watcher(sys.argv[1] if len(sys.argv) > 1 else linelist.datadir)
+    while True:
+        try:
+            watcher.refresh()
+        except Exception:
+            # keep watching, the next download may fix the problem
+            traceback.print_exc()
+        print('Waiting for new data')
+        watcher.wait()
+
+if __name__ == '__main__':
+    main()